@@ -1,17 +1,179 @@
 import json
+import logging
+import threading
+import time
+import Queue
+
+from contextlib import contextmanager
+from functools import wraps
+
 import redis
 
-from facile_backlog.websockets import NOTIFICATION_CHANNEL, REDIS_DB
+from facile_backlog.websockets import REDIS_DB
 from django.conf import settings
 
+logger = logging.getLogger(__name__)
+
+pool = None
+
+# notifications of the running request, published together at the end of
+# notification_batch
+local = threading.local()
+
+# lists of (channel, message) waiting to be published by the outbox thread
+outbox = Queue.Queue(maxsize=settings.NOTIFICATION_OUTBOX_SIZE)
+outbox_lock = threading.Lock()
+outbox_thread = None
+
+counters = {
+    'published': 0,
+    'retried': 0,
+    'dropped': 0,
+}
+
+
+def get_redis():
+    global pool
+    if pool is None:
+        host, _, port = settings.REDIS_URL.partition(":")
+        pool = redis.ConnectionPool(host=host, port=int(port), db=REDIS_DB)
+    return redis.Redis(connection_pool=pool)
+
+
+def publish(messages):
+    """
+    Publish the (channel, message) pairs, in one round trip when there are
+    many of them.
+    """
+    r = get_redis()
+    if len(messages) == 1:
+        r.publish(*messages[0])
+    else:
+        pipe = r.pipeline(transaction=False)
+        for channel, message in messages:
+            pipe.publish(channel, message)
+        pipe.execute()
+
+
+def count(name, value=1):
+    with outbox_lock:
+        counters[name] += value
+
+
+def publish_with_retry(messages):
+    """
+    Publish the messages, retrying with an exponential backoff while redis
+    is unavailable, they are dropped after the last retry.
+    """
+    delay = settings.NOTIFICATION_RETRY_DELAY
+    for attempt in range(settings.NOTIFICATION_RETRIES + 1):
+        if attempt:
+            count('retried')
+            time.sleep(delay)
+            delay *= 2
+        try:
+            publish(messages)
+        except redis.RedisError as ex:
+            logger.info(u"Notifications not published: {0}".format(ex))
+        else:
+            count('published', len(messages))
+            return
+    count('dropped', len(messages))
+    logger.warn(u"{0} notification(s) dropped".format(len(messages)))
+
+
+def outbox_worker():
+    while True:
+        messages = outbox.get()
+        # take along the messages queued meanwhile
+        pending = 1
+        try:
+            while True:
+                messages = messages + outbox.get_nowait()
+                pending += 1
+        except Queue.Empty:
+            pass
+        try:
+            publish_with_retry(messages)
+        except Exception:
+            count('dropped', len(messages))
+            logger.exception(u"Notification outbox error")
+        finally:
+            for i in range(pending):
+                outbox.task_done()
+
+
+def start_outbox():
+    global outbox_thread
+    with outbox_lock:
+        if outbox_thread is None or not outbox_thread.is_alive():
+            outbox_thread = threading.Thread(target=outbox_worker,
+                                             name="notification-outbox")
+            outbox_thread.daemon = True
+            outbox_thread.start()
+
+
+def deliver(messages):
+    """
+    Hand the messages to the outbox thread, the caller never waits for
+    redis. They are dropped when the outbox is full.
+    """
+    start_outbox()
+    try:
+        outbox.put_nowait(messages)
+    except Queue.Full:
+        count('dropped', len(messages))
+        logger.warn(u"Notification outbox full, {0} notification(s) "
+                    u"dropped".format(len(messages)))
+
+
+def flush_outbox():
+    """
+    Wait until all the queued notifications are published or dropped.
+    """
+    outbox.join()
+
 
 def notify_changes(o_type, o_id, data):
     redis_url = settings.REDIS_URL
     if redis_url:
-        host, _, port = settings.REDIS_URL.partition(":")
-        r = redis.Redis(host=host, port=int(port), db=REDIS_DB)
-        redis_data = {
-            'key': "{0}:{1}".format(o_type, o_id),
-            'data': data
-        }
-        r.publish(NOTIFICATION_CHANNEL, json.dumps(redis_data))
+        # each websocket channel key has its own redis channel
+        message = ("{0}:{1}".format(o_type, o_id), json.dumps(data))
+        batch = getattr(local, "batch", None)
+        if batch is not None:
+            batch.append(message)
+        else:
+            deliver([message])
+
+
+@contextmanager
+def notification_batch():
+    """
+    Collect the notifications sent inside the block and deliver them at
+    once when it exits, they are dropped if the block raises.
+    """
+    if getattr(local, "batch", None) is not None:
+        # already batching
+        yield
+        return
+    local.batch = []
+    try:
+        yield
+        messages = local.batch
+    finally:
+        local.batch = None
+    if messages:
+        deliver(messages)
+
+
+def notify_after_commit(func):
+    """
+    View decorator, to be put above the transaction decorator: notifications
+    are delivered once the transaction is committed, never while it is
+    still open, and not at all when it is rolled back.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with notification_batch():
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,7 +1,11 @@
 from rest_framework import serializers
 from rest_framework.reverse import reverse
 
-from ..backlog.models import (Project, Backlog, UserStory, Organization)
+from django.conf import settings
+from django.core.cache import cache
+
+from ..backlog.models import (Project, Backlog, UserStory, Organization,
+                              story_payload_cache_key)
 from ..core.models import User
 
 
@@ -30,16 +34,58 @@ class StorySerializer(serializers.ModelSerializer):
     project_id = serializers.SerializerMethodField('_proj_id')
     lang = serializers.SerializerMethodField('_proj_lang')
 
+    # fields depending on the request or on the project, the other fields
+    # are cached by story
+    request_fields = ('url', 'lang')
+
     class Meta:
         model = UserStory
         fields = ('id', 'url', 'code', 'as_a', 'i_want_to',
                   'so_i_can', 'color', 'comments', 'acceptances', 'points',
                   'theme', 'status', 'backlog_id', 'project_id', 'lang')
 
+    @property
+    def data(self):
+        if self._data is None and self.many:
+            # fetch the cached payloads of all the stories at once
+            self.object = list(self.object)
+            self._payloads = cache.get_many([
+                story_payload_cache_key(s.pk) for s in self.object])
+        return super(StorySerializer, self).data
+
+    def to_native(self, obj):
+        if obj is None or obj.pk is None:
+            return super(StorySerializer, self).to_native(obj)
+        key = story_payload_cache_key(obj.pk)
+        payloads = getattr(self, '_payloads', None)
+        if payloads is None:
+            payload = cache.get(key)
+        else:
+            payload = payloads.get(key)
+        if payload is None:
+            ret = super(StorySerializer, self).to_native(obj)
+            # a payload restricted to some fields is not cached
+            if len(ret) == len(self.Meta.fields):
+                cache.set(key, dict((k, v) for k, v in ret.items()
+                                    if k not in self.request_fields),
+                          settings.STORY_PAYLOAD_CACHE_TIMEOUT)
+            return ret
+        ret = self._dict_class()
+        for name in self.fields:
+            if name in self.request_fields:
+                ret[name] = getattr(self, self.fields[name].method_name)(obj)
+            else:
+                ret[name] = payload[name]
+        return ret
+
     def _url(self, obj):
-        return reverse("api_story_detail",
-                       args=[obj.backlog_id, obj.pk],
-                       request=self.context['request'])
+        # reversed once by backlog
+        urls = self.__dict__.setdefault('_backlog_urls', {})
+        if obj.backlog_id not in urls:
+            urls[obj.backlog_id] = reverse("api_stories",
+                                           args=[obj.backlog_id],
+                                           request=self.context['request'])
+        return u"{0}{1}/".format(urls[obj.backlog_id], obj.pk)
 
     def _backlog_id(self, obj):
         return obj.backlog_id
@@ -4,7 +4,8 @@ from .views import (home_view, project_list, project_detail,
                     backlog_detail, story_list, story_detail,
                     project_move_backlog, org_move_backlog,
                     move_story, org_list, org_detail, story_change_status,
-                    story_patch)
+                    story_patch, project_statistics, project_changes,
+                    story_bulk)
 
 urlpatterns = patterns(
     '',
@@ -19,6 +20,12 @@ urlpatterns = patterns(
     url(r'^projects/(?P<project_id>[\w]+)/$',
         project_detail, name="api_project_detail"),
 
+    url(r'^projects/(?P<project_id>[\w]+)/statistics/$',
+        project_statistics, name="api_project_statistics"),
+
+    url(r'^projects/(?P<project_id>[\w]+)/changes/$',
+        project_changes, name="api_project_changes"),
+
     url(r'^organizations/$',
         org_list, name="api_org_list"),
 
@@ -31,6 +38,9 @@ urlpatterns = patterns(
     url(r'^backlogs/(?P<backlog_id>[\w]+)/stories/$',
         story_list, name="api_stories"),
 
+    url(r'^backlogs/(?P<backlog_id>[\w]+)/stories/_bulk/$',
+        story_bulk, name="api_stories_bulk"),
+
     url(r'^backlogs/(?P<backlog_id>[\w]+)/stories/(?P<story_id>[\w]+)/$',
         story_detail, name="api_story_detail"),
 
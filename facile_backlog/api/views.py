@@ -1,3 +1,9 @@
+import base64
+import calendar
+import datetime
+import hashlib
+import urllib
+
 from rest_framework import viewsets
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
@@ -9,18 +15,23 @@ from rest_framework.throttling import UserRateThrottle
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
 from django.http import Http404
 from django.shortcuts import redirect
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext as _
 
-from .notify import notify_changes
+from .notify import notify_changes, notify_after_commit
 
 from .serializers import (ProjectSerializer, ProjectListSerializer,
                           BacklogSerializer, OrgListSerializer,
                           StorySerializer, OrgSerializer)
 
 from ..backlog.models import (Project, Backlog, UserStory, Organization,
-                              create_event, STATUS_CHOICE)
+                              StatisticCounter, create_event, reorder,
+                              invalidate_story_payloads, STATUS_CHOICE,
+                              STORY_ORDER_GAP)
 
 
 def get_or_errors(dic, value, errors=[]):
@@ -30,6 +41,20 @@ def get_or_errors(dic, value, errors=[]):
     return dic.get(value)
 
 
+def positive_int(value):
+    """
+    :return: the value as a positive int, None when it is not one
+    """
+    if isinstance(value, bool) or isinstance(value, float) and \
+            not value.is_integer():
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
 class AclPermission(BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated():
@@ -79,6 +104,74 @@ class ProjectViewSet(ProjectList):
     serializer_class = ProjectSerializer
 
 
+@api_view(["GET"])
+@throttle_classes([GeneralUserThrottle])
+def project_statistics(request, project_id):
+    """
+    All the statistic series of a project for the last 'days' days (all of
+    them by default), as columns sharing the 'days' timestamps.
+    """
+    project = get_object_or_404(Project, pk=project_id)
+    if not project.can_read(request.user):
+        raise Http404
+    days = request.QUERY_PARAMS.get('days', "")
+    days = int(days) if days.isdigit() else None
+    series = project.statistic_series()
+    result = {
+        'days': series['days'][:days],
+    }
+    for scope in ("all", "main"):
+        result[scope] = dict((status, values[:days]) for status, values
+                             in series[scope].items())
+    return Response(result, content_type="application/json", status=200)
+
+
+# changes committed this long after their modification date are still
+# reported, at the price of reporting some changes twice
+CHANGES_MARGIN = datetime.timedelta(seconds=5)
+
+
+def to_timestamp(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+@api_view(["GET"])
+@throttle_classes([GeneralUserThrottle])
+def project_changes(request, project_id):
+    """
+    Stories of the project changed or deleted after the 'since' timestamp,
+    and its backlogs modified meanwhile. Order changes do not modify the
+    stories, they only show through their backlog. The returned 'until'
+    timestamp is the 'since' of the next call.
+    """
+    project = get_object_or_404(Project, pk=project_id)
+    if not project.can_read(request.user):
+        raise Http404
+    try:
+        since = datetime.datetime.fromtimestamp(
+            float(request.QUERY_PARAMS.get('since', "")), timezone.utc)
+    except (ValueError, OverflowError):
+        return Response({
+            'errors': ["Missing or invalid 'since' timestamp"]
+        }, content_type="application/json", status=400)
+    until = timezone.now() - CHANGES_MARGIN
+    changed = list(project.stories.filter(modified__gt=since).values_list(
+        "pk", flat=True))
+    deleted = set(project.deleted_stories.filter(
+        deleted__gt=since).values_list("story_id", flat=True))
+    backlogs = Backlog.objects.filter(
+        Q(project=project) | Q(stories__project=project),
+        last_modified__gt=since
+    ).values_list("pk", flat=True).distinct()
+    return Response({
+        'since': to_timestamp(since),
+        'until': to_timestamp(max(since, until)),
+        'changed': sorted(changed),
+        'deleted': sorted(deleted),
+        'backlogs': sorted(backlogs),
+    }, content_type="application/json", status=200)
+
+
 project_list = ProjectList.as_view({
     'get': 'list',
 })
@@ -125,11 +218,51 @@ backlog_detail = BacklogViewSet.as_view({
 })
 
 
+# Model columns read for each serialized story field, the id, order, backlog
+# and project are always read.
+STORY_FIELD_COLUMNS = {
+    'id': (),
+    'url': (),
+    'code': ('code',),
+    'as_a': ('as_a',),
+    'i_want_to': ('i_want_to',),
+    'so_i_can': ('so_i_can',),
+    'color': ('color',),
+    'comments': ('comments',),
+    'acceptances': ('acceptances',),
+    'points': ('points',),
+    'theme': ('theme',),
+    'status': ('status',),
+    'backlog_id': (),
+    'project_id': (),
+    'lang': (),
+}
+STORY_BASE_COLUMNS = ('id', 'order', 'backlog', 'project')
+
+MAX_STORY_PAGE = 1000
+
+
+def encode_cursor(story):
+    return base64.urlsafe_b64encode("{0}:{1}".format(story.order, story.pk))
+
+
+def decode_cursor(cursor):
+    """
+    :return: tuple (order, pk) of the last story of the previous page
+    """
+    try:
+        order, pk = base64.urlsafe_b64decode(str(cursor)).split(":")
+        return int(order), int(pk)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor '{0}'".format(cursor))
+
+
 class StoryViewSet(viewsets.ModelViewSet):
     pk_url_kwarg = "story_id"
     serializer_class = StorySerializer
     model = UserStory
     permission_classes = (AclPermission,)
+    selected_fields = None
 
     def initial(self, request, *args, **kwargs):
         backlog_id = kwargs.pop("backlog_id")
@@ -157,6 +290,94 @@ class StoryViewSet(viewsets.ModelViewSet):
         obj.order = self.backlog.end_position
         super(StoryViewSet, self).pre_save(obj)
 
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(StoryViewSet, self).get_serializer(*args, **kwargs)
+        if self.selected_fields:
+            for name in serializer.fields.keys():
+                if name not in self.selected_fields:
+                    del serializer.fields[name]
+        return serializer
+
+    def list(self, request, *args, **kwargs):
+        """
+        Ordered stories of the backlog, optionally restricted to the
+        'fields' columns, and paginated by 'limit' following the 'cursor'
+        of the previous page.
+        """
+        last_modified = calendar.timegm(
+            self.backlog.last_modified.utctimetuple())
+        # the date has a one second precision, it is only given once no
+        # other change can share its second
+        settled = calendar.timegm(timezone.now().utctimetuple()) > \
+            last_modified
+        etag = '"{0}"'.format(hashlib.md5("{0}:{1}:{2}".format(
+            self.backlog.pk, self.backlog.last_modified.isoformat(),
+            request.META.get("QUERY_STRING", ""))).hexdigest())
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            not_modified = etag in [e.strip() for e in
+                                    if_none_match.split(",")]
+        else:
+            since = parse_http_date_safe(
+                request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+            not_modified = settled and since is not None and \
+                since >= last_modified
+        if not_modified:
+            response = Response(status=304)
+        else:
+            try:
+                response = self.list_page(request)
+            except ValueError as ex:
+                return Response({
+                    'errors': [unicode(ex)]
+                }, content_type="application/json", status=400)
+        response['ETag'] = etag
+        if settled:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list_page(self, request):
+        params = request.QUERY_PARAMS
+        queryset = self.get_queryset()
+        fields = params.get("fields")
+        if fields:
+            self.selected_fields = [f.strip() for f in fields.split(",")
+                                    if f.strip()]
+            unknown = [f for f in self.selected_fields
+                       if f not in STORY_FIELD_COLUMNS]
+            if unknown:
+                raise ValueError("Unknown field(s) {0}".format(
+                    ", ".join(unknown)))
+            if 'id' not in self.selected_fields:
+                self.selected_fields.insert(0, 'id')
+            columns = set(STORY_BASE_COLUMNS)
+            for name in self.selected_fields:
+                columns.update(STORY_FIELD_COLUMNS[name])
+            queryset = queryset.only(*columns)
+        limit = params.get("limit")
+        if limit is None:
+            return Response(self.get_serializer(queryset, many=True).data)
+
+        limit = int(limit)
+        if not 0 < limit <= MAX_STORY_PAGE:
+            raise ValueError("limit must be between 1 and {0}".format(
+                MAX_STORY_PAGE))
+        queryset = queryset.order_by("order", "pk")
+        cursor = params.get("cursor")
+        if cursor:
+            order, pk = decode_cursor(cursor)
+            queryset = queryset.filter(Q(order__gt=order) |
+                                       Q(order=order, pk__gt=pk))
+        stories = list(queryset[:limit + 1])
+        page, more = stories[:limit], len(stories) > limit
+        response = Response(self.get_serializer(page, many=True).data)
+        if more:
+            query = dict(params.items(), cursor=encode_cursor(page[-1]))
+            response['Link'] = '<{0}?{1}>; rel="next"'.format(
+                request.build_absolute_uri(request.path),
+                urllib.urlencode(sorted(query.items())))
+        return response
+
 
 story_list = StoryViewSet.as_view({
     'get': 'list',
@@ -170,10 +391,110 @@ story_detail = StoryViewSet.as_view({
     'delete': 'destroy'
 })
 
+MAX_BULK_STORIES = 1000
+
 
 @api_view(["POST"])
 @parser_classes((JSONParser,))
 @throttle_classes([GeneralUserThrottle])
+@notify_after_commit
+@transaction.commit_on_success
+def story_bulk(request, backlog_id):
+    """
+    [
+        {story fields, with the "id" of the story to update, without "id"
+         to create a new story at the end of the backlog},
+        ...
+    ]
+    :return: the created and updated stories, in the request order
+    """
+    backlog = get_object_or_404(Backlog, pk=backlog_id)
+    if not backlog.can_admin(request.user):
+        if backlog.can_read(request.user):
+            return Response("You are not admin of this backlog",
+                            content_type="application/json", status=403)
+        raise Http404
+    items = request.DATA
+    if not isinstance(items, list) or not items:
+        return Response({
+            'errors': ["Content must be a list of stories"]
+        }, content_type="application/json", status=400)
+    if len(items) > MAX_BULK_STORIES:
+        return Response({
+            'errors': ["At most {0} stories at once".format(
+                MAX_BULK_STORIES)]
+        }, content_type="application/json", status=400)
+
+    errors = {}
+    ids = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = ["Story must be an object"]
+        elif 'id' in item:
+            ids[index] = positive_int(item['id'])
+            if ids[index] is None:
+                errors[index] = ["Story id must be a positive integer"]
+
+    context = {'request': request}
+    existing = UserStory.objects.in_bulk(
+        [i for i in ids.values() if i is not None])
+    checked = []
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
+        story = existing.get(ids.get(index))
+        if 'id' in item and (not story or story.backlog_id != backlog.pk):
+            errors[index] = ["Unknown story {0} in backlog {1}".format(
+                item['id'], backlog.pk)]
+            continue
+        if not story and not backlog.project_id:
+            errors[index] = ["Stories are created in project backlogs"]
+            continue
+        serializer = StorySerializer(story, data=item, partial=bool(story),
+                                     context=context)
+        if serializer.is_valid():
+            checked.append(serializer)
+        else:
+            errors[index] = serializer.errors
+    if errors:
+        return Response({
+            'errors': errors
+        }, content_type="application/json", status=400)
+
+    created = [s.object for s in checked if not s.object.pk]
+    if created:
+        first = backlog.project.reserve_story_numbers(len(created))
+        end = backlog.end_position
+        for i, story in enumerate(created):
+            story.project = backlog.project
+            story.backlog = backlog
+            story.number = first + i
+            story.code = story.get_initial_code()
+            story.order = end + i * STORY_ORDER_GAP
+        UserStory.objects.bulk_create(created)
+        stored = dict(backlog.project.stories.filter(
+            number__gte=first, number__lt=first + len(created)
+        ).values_list("number", "pk"))
+        for story in created:
+            story.pk = stored[story.number]
+        invalidate_story_payloads(*stored.values())
+        StatisticCounter.stories_added(s.statistic_state() for s in created)
+        created[0].touch_backlog()
+    for serializer in checked:
+        if serializer.object.pk in existing:
+            serializer.save()
+    if created:
+        # one full order of the backlog for the whole batch
+        notify_backlog_changed(request, backlog, created[-1], None)
+    return Response([s.data for s in checked],
+                    content_type="application/json",
+                    status=201 if len(created) == len(items) else 200)
+
+
+@api_view(["POST"])
+@parser_classes((JSONParser,))
+@throttle_classes([GeneralUserThrottle])
+@notify_after_commit
 @transaction.commit_on_success
 def move_story(request):
     """
@@ -254,22 +575,11 @@ def move_story(request):
     else:
         touched = False
     # handle order backlog
-    end_index = len(order)
     if order:
-        for story in backlog.ordered_stories:
-            try:
-                new_index = order.index(story.pk)
-            except ValueError:
-                new_index = end_index
-                end_index += 1
-            if new_index != story.order:
-                story.order = new_index
-                story.save(update_fields=('order',))
-                touched = True
+        moved, neighbours = backlog.move_story(story, order)
+        touched = touched or moved
     else:
-        max_order = max([s.order for s in backlog.stories.all()])
-        story.order = max_order+1
-        story.save(update_fields=('order',))
+        neighbours = backlog.append_story(story)
         touched = True
 
     if touched:
@@ -280,29 +590,51 @@ def move_story(request):
             backlog=backlog,
             story=story,
         )
-        notify_backlog_changed(request, backlog, order, story_id)
+        notify_backlog_changed(request, backlog, story, neighbours,
+                               source=old_backlog)
 
     return Response({
         'ok': True
     })
 
 
-def notify_backlog_changed(request, backlog, order, moved_story=None):
-    to_notify = []  # Tuple of (type, id)
+def _notified_channels(backlog):
     if backlog.project_id:
-        to_notify.append(("projects", backlog.project_id))
+        yield "projects", backlog.project_id
         if backlog.project.org_id:
-            to_notify.append(("organizations", backlog.project.org_id))
+            yield "organizations", backlog.project.org_id
+    else:
+        yield "organizations", backlog.org_id
+
+
+def notify_backlog_changed(request, backlog, story, neighbours,
+                           source=None):
+    """
+    Notify the move of 'story' to 'backlog' with its new (previous id,
+    next id) neighbours, or with the full order of the backlog when
+    'neighbours' is None. Each move increments the revision of the backlog
+    (and of the 'source' backlog), clients missing a revision resync.
+    """
+    data = {
+        'backlog_id': backlog.pk,
+        'revision': backlog.next_revision(),
+        'type': "stories_moved",
+        'moved_story_id': story.pk,
+        'username': request.user.email,
+    }
+    channels = list(_notified_channels(backlog))
+    if source and source.pk != backlog.pk:
+        data['source_backlog_id'] = source.pk
+        data['source_revision'] = source.next_revision()
+        channels.extend(c for c in _notified_channels(source)
+                        if c not in channels)
+    if neighbours is None:
+        data['order'] = list(backlog.stories.order_by(
+            'order').values_list('pk', flat=True))
     else:
-        to_notify.append(("organizations", backlog.org_id))
-    for pair in to_notify:
-        notify_changes(pair[0], pair[1], {
-            'backlog_id': backlog.pk,
-            'type': "stories_moved",
-            'order': [s.pk for s in backlog.ordered_stories.all()],
-            'moved_story_id': moved_story,
-            'username': request.user.email,
-        })
+        data['previous_story_id'], data['next_story_id'] = neighbours
+    for o_type, o_id in channels:
+        notify_changes(o_type, o_id, data)
 
 
 def notify_story_changed(request, story):
@@ -326,20 +658,8 @@ def _move_backlog(request, o_type, qs, object_id):
             'errors': errors
         }, content_type="application/json", status=400)
     order = [int(x) for x in order]
-    end_index = len(order)
-    for backlog in obj.backlogs.all():
-        try:
-            new_index = order.index(backlog.pk)
-        except ValueError:
-            new_index = end_index
-            end_index += 1
-        touched = False
-        if new_index != backlog.order:
-            backlog.order = new_index
-            backlog.save(update_fields=('order',))
-            touched = True
-        if touched:
-            obj.save()  # last modified is modified
+    if reorder(obj.backlogs.all(), order):
+        obj.save()  # last modified is modified
     notify_changes(o_type, object_id, {
         'type': "backlogs_moved",
         'order': order,
@@ -353,22 +673,27 @@ def _move_backlog(request, o_type, qs, object_id):
 @api_view(["POST"])
 @parser_classes((JSONParser,))
 @throttle_classes([GeneralUserThrottle])
+@notify_after_commit
 @transaction.commit_on_success
 def project_move_backlog(request, project_id):
-    return _move_backlog(request, "Project", request.user.projects, project_id)
+    return _move_backlog(request, "projects", request.user.projects,
+                         project_id)
 
 
 @api_view(["POST"])
 @parser_classes((JSONParser,))
 @throttle_classes([GeneralUserThrottle])
+@notify_after_commit
 @transaction.commit_on_success
 def org_move_backlog(request, org_id):
-    return _move_backlog(request, "Org", request.user.organizations, org_id)
+    return _move_backlog(request, "organizations", request.user.organizations,
+                         org_id)
 
 
 @api_view(["POST", "GET"])
 @parser_classes((JSONParser,))
 @throttle_classes([GeneralUserThrottle])
+@notify_after_commit
 @transaction.commit_on_success
 def story_change_status(request, story_id):
     story = get_object_or_404(UserStory, pk=story_id)
@@ -447,6 +772,7 @@ class StoryPatcher(object):
 @api_view(["POST"])
 @parser_classes((JSONParser,))
 @throttle_classes([GeneralUserThrottle])
+@notify_after_commit
 @transaction.commit_on_success
 def story_patch(request, story_id):
     story = get_object_or_404(UserStory, pk=story_id)
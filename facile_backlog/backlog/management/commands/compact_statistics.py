@@ -6,9 +6,8 @@ from django.core.management.base import BaseCommand
 
 from optparse import make_option
 
-from raven import Client
-
 from ...models import Project
+from ..runner import run_projects, log_run, DEFAULT_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -22,23 +21,19 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--ignore-errors', action='store_true', default=False,
                     help='Ignore import errors'),
+        make_option('--workers', type='int', default=1,
+                    help='Number of worker processes'),
+        make_option('--chunk-size', type='int', default=DEFAULT_CHUNK_SIZE,
+                    help='Number of projects given at once to a worker'),
     )
 
     def handle(self, *args, **options):
         if len(args) >= 1:
-            pk = int(args[0])
+            pks = [int(args[0])]
         else:
-            pk = None
-        for project in Project.objects.all():
-            if not pk or pk == project.pk:
-                try:
-                    project.compact_statistics()
-                except Exception as ex:
-                    Client().captureException(ex)
-                else:
-                    logger.log(
-                        logging.DEBUG,
-                        u"Compact statistics for "
-                        u"project: '{0}' [{1}] ({2})".format(
-                            project.name, project.code, project.pk))
-        logger.log(logging.INFO, u"Statistics compacted")
+            pks = list(Project.objects.values_list("pk", flat=True))
+        done, errors, elapsed = run_projects(
+            "compact_statistics", pks,
+            workers=options.get('workers') or 1,
+            chunk_size=options.get('chunk_size') or DEFAULT_CHUNK_SIZE)
+        log_run(u"Statistics compacted", done, errors, elapsed)
@@ -1,15 +1,22 @@
 import logging
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
 import requests
 
+from requests.adapters import HTTPAdapter
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 from optparse import make_option
 
-from ...models import (Project, Backlog, UserStory, create_event, Status)
+from ...models import (Project, Backlog, UserStory, Event, Status,
+                       StatisticCounter, build_event_kwargs)
 
 from ....core.models import User
 
@@ -19,14 +26,17 @@ logger = logging.getLogger(__name__)
 AUTH_TOKEN = settings.EASYBACKLOG_TOKEN
 
 
-def easy_request(path):
-    url = urlparse.urljoin("https://easybacklog.com/api/", path)
-    return requests.get(
-        url,
-        headers={
-            'Authorization': "token {0}".format(AUTH_TOKEN)
-        }
-    )
+def easy_session(threads):
+    """
+    HTTP session shared by the fetching threads, keeping a connection to the
+    API open for each of them
+    """
+    session = requests.Session()
+    session.headers['Authorization'] = "token {0}".format(AUTH_TOKEN)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 def empty_string_dict(dico, key, default=""):
@@ -54,6 +64,11 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--ignore-errors', action='store_true', default=False,
                     help='Ignore import errors'),
+        make_option('--api-url', default=settings.EASYBACKLOG_API_URL,
+                    help='Base url of the easybacklog API'),
+        make_option('--threads', type='int',
+                    default=settings.EASYBACKLOG_IMPORT_THREADS,
+                    help='Number of concurrent API requests'),
     )
 
     def handle(self, *args, **options):
@@ -63,12 +78,35 @@ class Command(BaseCommand):
         self.eb_company_name = unicode(args[1], "utf-8")
         self.eb_backlog_name = unicode(args[2], "utf-8")
         self.project_name = unicode(args[3], "utf-8")
-        self.fill_status()
         self.project_map = dict()  # Hold company_id-->project
-
-        accounts = self.get_accounts()
-        for account in accounts:
-            self.handle_account(account)
+        self.api_url = options.get('api_url', settings.EASYBACKLOG_API_URL)
+        threads = options.get('threads', settings.EASYBACKLOG_IMPORT_THREADS)
+        self.session = easy_session(threads)
+        self.pool = ThreadPool(threads)
+        try:
+            status_list = self.fetch("sprint-story-statuses")
+            accounts = self.fetch("accounts")
+            self.fill_status(status_list.get())
+            for account in accounts.get():
+                self.handle_account(account)
+        finally:
+            self.pool.terminate()
+            self.session.close()
+
+    def easy_request(self, path):
+        """
+        :return: the decoded json answer of the API
+        """
+        response = self.session.get(urlparse.urljoin(self.api_url, path))
+        response.raise_for_status()
+        return response.json()
+
+    def fetch(self, path):
+        """
+        Request the path in a thread of the pool
+        :return: AsyncResult of the decoded json answer
+        """
+        return self.pool.apply_async(self.easy_request, (path,))
 
     def create_project(self, external_id, name):
         description = "Imported from easy backlog :{0}".format(external_id)
@@ -107,11 +145,13 @@ class Command(BaseCommand):
             stand_alone = True
         else:
             stand_alone = False
-        companies = self.get_companies(account_id)
+        # both lists are fetched at once
+        companies = self.fetch("accounts/{0}/companies".format(account_id))
+        backlogs = self.fetch("accounts/{0}/backlogs".format(account_id))
 
         self.eb_company = None
         if not stand_alone:
-            for company in companies:
+            for company in companies.get():
                 if self.eb_company_name in (company['id'], company['name']):
                     self.eb_company = company
             if not self.eb_company:
@@ -120,12 +160,8 @@ class Command(BaseCommand):
                 )
                 return
 
-        backlogs = easy_request(
-            "accounts/{0}/backlogs".format(account_id)
-        ).json()
-
         found = 0
-        for backlog in backlogs:
+        for backlog in backlogs.get():
             company_id = backlog.get('company_id', None)
             if stand_alone and not company_id:
                 if self.handle_backlog(backlog):
@@ -152,39 +188,71 @@ class Command(BaseCommand):
         if self.user:
             project.add_user(self.user, is_admin=True)
 
-        story_status = self.get_stories_status(backlog_id)
-
-        themes = easy_request(
-            "backlogs/{0}/themes".format(backlog_id)
-        ).json()
-        for theme in themes:
-            self.handle_theme(project, backlog,
-                              theme, story_status)
-
-        # place stories in the right backlog
-        for story in UserStory.objects.filter(project=project):
-            if story.status == Status.ACCEPTED:
-                story.backlog = project.accepted_backlog
-                story.save()
+        sprints = self.fetch(
+            "backlogs/{0}/sprints?include_associated_data=true".format(
+                backlog_id)
+        )
+        themes = self.easy_request("backlogs/{0}/themes".format(backlog_id))
+        # the stories of the next themes are fetched while the previous ones
+        # are inserted
+        theme_stories = self.pool.imap(self.get_theme_stories, themes)
+        story_status = self.get_stories_status(sprints.get())
+        for theme, stories in zip(themes, theme_stories):
+            self.handle_theme(project, backlog, theme, stories, story_status)
+        Backlog.objects.filter(project=project).update(
+            last_modified=timezone.now())
         return project
 
-    def handle_theme(self, project, backlog, easy_theme, story_status):
-        theme_id = easy_theme['id']
-        stories = easy_request(
-            "themes/{0}/stories?include_associated_data=true".format(theme_id)
-        ).json()
-        for story in stories:
-            self.handle_story(project, backlog, story,
-                              easy_theme, story_status)
-
-    def handle_story(self, project, backlog, easy_story,
-                     easy_theme, story_status):
+    def get_theme_stories(self, easy_theme):
+        return self.easy_request(
+            "themes/{0}/stories?include_associated_data=true".format(
+                easy_theme['id'])
+        )
+
+    @transaction.commit_on_success
+    def handle_theme(self, project, backlog, easy_theme, easy_stories,
+                     story_status):
+        """
+        Insert the stories of the theme and their events at once, accepted
+        stories go straight to the accepted backlog
+        """
+        if not easy_stories:
+            return
+        first = project.reserve_story_numbers(len(easy_stories))
+        stories = []
+        for i, easy_story in enumerate(easy_stories):
+            story = self.build_story(project, backlog, easy_story,
+                                     easy_theme, story_status)
+            story.number = first + i
+            story.code = story.get_initial_code()
+            stories.append(story)
+        UserStory.objects.bulk_create(stories)
+        stored = dict(project.stories.filter(
+            number__gte=first, number__lt=first + len(stories)
+        ).values_list("number", "pk"))
+        Event.objects.bulk_create([
+            Event(**build_event_kwargs(
+                {'text': u"imported story from easy backlog id={0}".format(
+                    easy_story['id'])},
+                user=self.user, project=project, backlog=backlog,
+                story=stored[story.number],
+            )) for story, easy_story in zip(stories, easy_stories)
+        ])
+        StatisticCounter.stories_added(s.statistic_state() for s in stories)
+        logger.log(logging.INFO, "Stories {0} to {1} imported".format(
+            stories[0].code, stories[-1].code))
+
+    def build_story(self, project, backlog, easy_story,
+                    easy_theme, story_status):
         story_id = easy_story['id']
         acceptances = self.format_acceptances(
             easy_story[u'acceptance_criteria'])
-        story = UserStory(
+        status = story_status.get(story_id, Status.TODO)
+        if status == Status.ACCEPTED:
+            backlog = project.accepted_backlog
+        return UserStory(
             project=project,
-            status=story_status.get(story_id, Status.TODO),
+            status=status,
             as_a=empty_string_dict(easy_story, 'as_a'),
             i_want_to=empty_string_dict(easy_story, 'i_want_to'),
             so_i_can=empty_string_dict(easy_story, 'so_i_can'),
@@ -197,13 +265,6 @@ class Command(BaseCommand):
             backlog=backlog,
             order=int(easy_story['position'])
         )
-        story.save()
-        create_event(
-            self.user, project=project,
-            text=u"imported story from easy backlog id={0}".format(story_id),
-            backlog=backlog, story=story
-        )
-        logger.log(logging.INFO, "Story {0} imported".format(story.code))
 
     def format_acceptances(self, acceptances):
         return "".join((
@@ -211,11 +272,7 @@ class Command(BaseCommand):
             for a in acceptances
         ))
 
-    def get_stories_status(self, backlog_id):
-        sprints = easy_request(
-            "backlogs/{0}/sprints?include_associated_data=true".format(
-                backlog_id)
-        ).json()
+    def get_stories_status(self, sprints):
         result = dict()
         for sprint in sprints:
             for story in sprint['sprint_stories']:
@@ -223,16 +280,7 @@ class Command(BaseCommand):
                 result[story['story_id']] = status
         return result
 
-    def get_accounts(self):
-        result = easy_request("accounts")
-        return result.json()
-
-    def get_companies(self, account_id):
-        result = easy_request("accounts/{0}/companies".format(account_id))
-        return result.json()
-
-    def fill_status(self):
-        status_list = easy_request("sprint-story-statuses").json()
+    def fill_status(self, status_list):
         result = dict()
         for status in status_list:
             result[status['id']] = status['status'].lower().replace(" ", "_")
@@ -3,12 +3,12 @@ import logging
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Max
 
 from optparse import make_option
 
-from raven import Client
-
-from ...models import Project
+from ...models import Project, Backlog, UserStory, DeletedStory
+from ..runner import run_projects, log_run, DEFAULT_CHUNK_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -16,24 +16,50 @@ logger = logging.getLogger(__name__)
 AUTH_TOKEN = settings.EASYBACKLOG_TOKEN
 
 
+def changed_projects():
+    """
+    :return: the pks of the projects modified since their latest statistic,
+    or without any statistic. Story changes and deletions do not touch their
+    project, the latest of them is looked up too.
+    """
+    latest = dict(Project.objects.annotate(
+        latest=Max("statistics__day")
+    ).values_list("pk", "latest"))
+    modified = dict(Project.objects.values_list("pk", "last_modified"))
+    for model, field in ((UserStory, "modified"),
+                         (Backlog, "last_modified"),
+                         (DeletedStory, "deleted")):
+        for pk, value in model.objects.filter(
+                project__isnull=False
+        ).values_list("project_id").annotate(Max(field)):
+            if pk in modified and value > modified[pk]:
+                modified[pk] = value
+    return sorted(pk for pk, value in modified.items()
+                  if not latest.get(pk) or value.date() >= latest[pk])
+
+
 class Command(BaseCommand):
     args = ''
     help = 'Generate daily statistics for project(s)'
     option_list = BaseCommand.option_list + (
         make_option('--ignore-errors', action='store_true', default=False,
                     help='Ignore import errors'),
+        make_option('--workers', type='int', default=1,
+                    help='Number of worker processes'),
+        make_option('--chunk-size', type='int', default=DEFAULT_CHUNK_SIZE,
+                    help='Number of projects given at once to a worker'),
+        make_option('--since', action='store_true', default=False,
+                    help='Skip projects not modified since their latest '
+                         'statistics'),
     )
 
     def handle(self, *args, **options):
-        for project in Project.objects.all():
-            try:
-                project.generate_daily_statistics()
-            except Exception as ex:
-                Client().captureException(ex)
-            else:
-                logger.log(
-                    logging.DEBUG,
-                    u"Daily statistics generated for "
-                    u"project: '{0}' [{1}] ({2})".format(
-                        project.name, project.code, project.pk))
-        logger.log(logging.INFO, u"Daily statistics generated")
+        if options.get('since'):
+            pks = changed_projects()
+        else:
+            pks = list(Project.objects.values_list("pk", flat=True))
+        done, errors, elapsed = run_projects(
+            "generate_daily_statistics", pks,
+            workers=options.get('workers') or 1,
+            chunk_size=options.get('chunk_size') or DEFAULT_CHUNK_SIZE)
+        log_run(u"Daily statistics generated", done, errors, elapsed)
@@ -0,0 +1,80 @@
+import logging
+import multiprocessing
+import time
+
+from django.db import connections
+
+from raven import Client
+
+from ..models import Project
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_SIZE = 100
+
+
+def close_connections():
+    """
+    Closes the database connections, a forked process must open its own
+    connection instead of sharing the socket of its parent.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def run_chunk(args):
+    """
+    Calls the method on every project of the chunk.
+    :param args: tuple (method name, project pks)
+    :return: tuple (processed count, error count)
+    """
+    method, pks = args
+    done = errors = 0
+    for project in Project.objects.filter(pk__in=pks):
+        try:
+            getattr(project, method)()
+        except Exception as ex:
+            errors += 1
+            Client().captureException(ex)
+        else:
+            done += 1
+            logger.log(
+                logging.DEBUG,
+                u"{0} done for project: '{1}' [{2}] ({3})".format(
+                    method, project.name, project.code, project.pk))
+    return done, errors
+
+
+def run_projects(method, pks, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Calls the method on the given projects, split in chunks processed by a
+    pool of 'workers' processes (in the current process if workers <= 1).
+    :param method: name of the Project method to call
+    :param pks: list of project pks
+    :return: tuple (processed count, error count, elapsed seconds)
+    """
+    start = time.time()
+    chunks = [(method, pks[i:i + chunk_size])
+              for i in range(0, len(pks), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        close_connections()
+        pool = multiprocessing.Pool(workers, initializer=close_connections)
+        try:
+            results = pool.map(run_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_chunk, chunks)
+    done = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    return done, errors, time.time() - start
+
+
+def log_run(message, done, errors, elapsed):
+    logger.log(
+        logging.INFO,
+        u"{0}: {1} project(s) in {2:.2f}s ({3:.1f} projects/s), "
+        u"{4} error(s)".format(message, done, elapsed,
+                               done / elapsed if elapsed else 0.0, errors))
@@ -1,14 +1,20 @@
 import re
+import json
+import hashlib
 import datetime
 import calendar
-
-from collections import defaultdict
+import threading
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
 from django.core.urlresolvers import reverse
 from django.core.validators import EmailValidator, URLValidator
-from django.db import models, transaction
+from django.db import (models, transaction, connections, router,
+                       IntegrityError)
 from django.db.models.loading import get_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
@@ -27,6 +33,11 @@ LONG_AGO = timezone.make_aware(datetime.datetime(2012, 7, 2),
 
 EMPTY = ""
 
+# Stories are ordered with sparse keys, a moved story takes the middle of
+# the gap between its neighbours, the backlog is re-numbered only when
+# there is no gap left.
+STORY_ORDER_GAP = 1024
+
 
 class Status(object):
     TODO = "to_do"
@@ -69,38 +80,82 @@ def status_index_for(key):
     raise KeyError("Unknown key {0}".format(key))
 
 
+def story_stats(queryset, *fields):
+    """
+    Groups the stories of the queryset by status and estimation, counts the
+    stories and sums their points with a single query.
+    :param queryset: the user stories to aggregate
+    :param fields: additional grouping fields (e.g. "backlog_id")
+    :return: a ValuesQuerySet of dicts with 'count' and 'points_sum' keys
+    """
+    estimated = "{0}.points >= 0".format(UserStory._meta.db_table)
+    return queryset.extra(select={'estimated': estimated}).values(
+        *(fields + ("status", "estimated"))
+    ).annotate(
+        count=models.Count("pk"), points_sum=models.Sum("points")
+    ).order_by()
+
+
+def prefetch_stats(backlogs):
+    """
+    Computes the stats of all the backlogs in one query, so that iterating
+    over their 'stats' does not hit the database once per backlog.
+    :param backlogs: an iterable of Backlog
+    :return: the list of backlogs
+    """
+    backlogs = list(backlogs)
+    rows = dict((b.pk, []) for b in backlogs)
+    if rows:
+        for row in story_stats(UserStory.objects.filter(
+                backlog_id__in=rows.keys()), "backlog_id"):
+            rows[row['backlog_id']].append(row)
+    for backlog in backlogs:
+        backlog.build_stats(rows[backlog.pk])
+    return backlogs
+
+
 class StatsMixin(object):
     @property
     def stats(self):
         if not hasattr(self, "_stats"):
-            result = dict()
-            story_stats = self.stories.values_list("points", "status")
-            estimated = [v[0] for v in story_stats if v[0] >= 0]
-            completed = [v[0] for v in story_stats if
-                         v[1] in (Status.COMPLETED, Status.ACCEPTED)
-                         and v[0] >= 0]
-            if len(story_stats):
-                result['total_stories'] = len(story_stats)
-                result['estimated_stories'] = len(estimated)
-                result['completed_stories'] = len(completed)
-                result['percent_estimated'] = \
-                    float(len(estimated)) / float(len(story_stats)) * 100.0
-                result['percent_completed'] = \
-                    float(len(completed)) / float(len(story_stats)) * 100.0
-
-                result['total_points'] = int(sum(estimated))
-                result['estimated_points'] = int(sum(estimated))
-                result['completed_points'] = int(sum(completed))
-            else:
-                result['total_stories'] = 0
-                result['total_points'] = 0
-                result['percent_estimated'] = 0
-                result['percent_completed'] = 0
-
-            result.update(self.get_stats())
-            self._stats = result
+            self.build_stats(story_stats(self.stories))
         return self._stats
 
+    def build_stats(self, rows):
+        total = estimated = completed = 0
+        estimated_points = completed_points = 0.0
+        for row in rows:
+            total += row['count']
+            if not row['estimated']:
+                continue
+            estimated += row['count']
+            estimated_points += row['points_sum']
+            if row['status'] in (Status.COMPLETED, Status.ACCEPTED):
+                completed += row['count']
+                completed_points += row['points_sum']
+        result = dict()
+        if total:
+            result['total_stories'] = total
+            result['estimated_stories'] = estimated
+            result['completed_stories'] = completed
+            result['percent_estimated'] = \
+                float(estimated) / float(total) * 100.0
+            result['percent_completed'] = \
+                float(completed) / float(total) * 100.0
+
+            result['total_points'] = int(estimated_points)
+            result['estimated_points'] = int(estimated_points)
+            result['completed_points'] = int(completed_points)
+        else:
+            result['total_stories'] = 0
+            result['total_points'] = 0
+            result['percent_estimated'] = 0
+            result['percent_completed'] = 0
+
+        result.update(self.get_stats())
+        self._stats = result
+        return result
+
     def get_stats(self):
         return {}
 
@@ -116,6 +171,50 @@ class WithThemeMixin(object):
         return self._all_themes
 
 
+# cache keys to delete again once the transaction of the running request
+# is over, by thread
+uncommitted_keys = threading.local()
+
+
+def delete_cached(keys):
+    """
+    Delete the cache keys now and, when a transaction is open, again at the
+    end of the request, after its commit: a concurrent request reading
+    before the commit may have cached the old values meanwhile.
+    """
+    if not keys:
+        return
+    cache.delete_many(keys)
+    if transaction.get_autocommit() and \
+            not transaction.get_connection().in_atomic_block:
+        return
+    pending = getattr(uncommitted_keys, "keys", None)
+    if pending is None:
+        pending = uncommitted_keys.keys = set()
+    pending.update(keys)
+
+
+@receiver(request_started)
+@receiver(request_finished)
+def delete_uncommitted_keys(sender, **kwargs):
+    # keys left outside of a request are dropped when the next one starts
+    pending = getattr(uncommitted_keys, "keys", None)
+    uncommitted_keys.keys = None
+    if pending:
+        cache.delete_many(list(pending))
+
+
+def acl_cache_key(field, pk):
+    return "backlogman.acl:{0}:{1}".format(field, pk)
+
+
+def invalidate_acl(field, *pks):
+    """
+    Drop the shared ACL of the given owners, next access will rebuild it
+    """
+    delete_cached([acl_cache_key(field, pk) for pk in pks if pk])
+
+
 class AuthorizationAssociation(models.Model):
     org = models.ForeignKey('Organization', null=True, blank=True,
                             related_name="authorizations")
@@ -189,11 +288,18 @@ class AuthorizationAssociation(models.Model):
         org_id = self.org_id
         super(AuthorizationAssociation, self).delete()
         if org_id:
+            project_ids = list(self.org.projects.values_list("pk", flat=True))
             AuthorizationAssociation.objects.filter(
                 user=self.user,
-                project__in=self.org.projects.values_list("pk", flat=True)
+                project__in=project_ids
             ).delete()
 
+    def invalidate_acl(self):
+        if self.project_id:
+            invalidate_acl("project", self.project_id)
+        if self.org_id:
+            invalidate_acl("org", self.org_id)
+
     @property
     def is_guest(self):
         """
@@ -217,6 +323,14 @@ class AuthorizationAssociation(models.Model):
         return False
 
 
+@receiver(post_save, sender=AuthorizationAssociation)
+@receiver(post_delete, sender=AuthorizationAssociation)
+def authorization_changed(sender, instance, **kwargs):
+    # also sent for the associations deleted in cascade with their user,
+    # project or organization
+    instance.invalidate_acl()
+
+
 class AclMixin(object):
     authorization_association_field = None
 
@@ -224,27 +338,45 @@ class AclMixin(object):
         return self
 
     def get_acl(self):
+        """
+        Return the 'read' and 'admin' user id sets of the ACL owner.
+        The result is kept on the instance and shared through the cache,
+        see invalidate_acl()
+        """
         if not hasattr(self, '__acl__'):
-            self.__acl__ = {
-                'read': [],
-                'admin': []
-            }
-            kwargs = dict()
-            kwargs['is_active'] = True
-            kwargs[self.authorization_association_field] = self.get_acl_owner()
-            for auth in AuthorizationAssociation.objects.filter(
-                    **kwargs
-            ).prefetch_related():
-                self.__acl__['read'].append(auth.user.email)
-                if auth.is_admin:
-                    self.__acl__['admin'].append(auth.user.email)
+            owner = self.get_acl_owner()
+            owner_pk = getattr(owner, 'pk', None)
+            key = acl_cache_key(self.authorization_association_field,
+                                owner_pk)
+            acl = cache.get(key) if owner_pk else None
+            if acl is None:
+                acl = self._build_acl(owner)
+                if owner_pk:
+                    cache.set(key, acl, settings.ACL_CACHE_TIMEOUT)
+            self.__acl__ = acl
         return self.__acl__
 
+    def _build_acl(self, owner):
+        acl = {
+            'read': set(),
+            'admin': set()
+        }
+        kwargs = dict()
+        kwargs['is_active'] = True
+        kwargs[self.authorization_association_field] = owner
+        for user_id, is_admin in AuthorizationAssociation.objects.filter(
+                **kwargs
+        ).values_list("user_id", "is_admin"):
+            acl['read'].add(user_id)
+            if is_admin:
+                acl['admin'].add(user_id)
+        return acl
+
     def can_read(self, user):
-        return user.is_staff or (user.email in self.get_acl()['read'])
+        return user.is_staff or (user.pk in self.get_acl()['read'])
 
     def can_admin(self, user):
-        return user.is_staff or (user.email in self.get_acl()['admin'])
+        return user.is_staff or (user.pk in self.get_acl()['admin'])
 
 
 class Organization(AclMixin, WithThemeMixin, models.Model):
@@ -273,6 +405,14 @@ class Organization(AclMixin, WithThemeMixin, models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        created = not self.pk
+        result = super(Organization, self).save(*args, **kwargs)
+        if created:
+            # a recycled primary key must not inherit a stale ACL
+            invalidate_acl("org", self.pk)
+        return result
+
     @classmethod
     def my_organizations(cls, user):
         """ Return all organization user has rights """
@@ -312,6 +452,7 @@ class Organization(AclMixin, WithThemeMixin, models.Model):
         AuthorizationAssociation.objects.filter(
             user=user, org=self
         ).delete()
+        invalidate_acl("org", self.pk)
 
     @property
     def main_backlog(self):
@@ -360,12 +501,43 @@ class Organization(AclMixin, WithThemeMixin, models.Model):
                 is_active=auth.is_active,
             )
         project.save()
+        invalidate_acl("project", project.pk)
 
     @property
     def active_projects(self):
         return self.projects.filter(is_archive=False).order_by("name")
 
 
+# blocks of story numbers reserved by this process and not handed out yet,
+# by project pk, as [next number, last number]
+story_numbers = {}
+story_numbers_locks = {}
+
+# increments the counter of reserved numbers only when it exists, it is
+# seeded from the database otherwise
+INCR_STORY_NUMBERS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+"""
+
+
+def story_numbers_key(pk):
+    return "backlogman.story_numbers:{0}".format(pk)
+
+
+def forget_story_numbers(pk):
+    """
+    Drop the reserved story numbers of the project, in this process and in
+    redis. Blocks kept by other processes are not dropped, primary keys are
+    not recycled by the production database.
+    """
+    story_numbers.pop(pk, None)
+    if settings.REDIS_URL:
+        from ..api.notify import get_redis
+        get_redis().delete(story_numbers_key(pk))
+
+
 class Project(StatsMixin, WithThemeMixin, AclMixin, models.Model):
     authorization_association_field = "project"
 
@@ -399,6 +571,62 @@ class Project(StatsMixin, WithThemeMixin, AclMixin, models.Model):
     def get_absolute_url(self):
         return reverse("project_detail", args=(self.pk,))
 
+    def reserve_story_numbers(self, count):
+        """
+        Reserve 'count' consecutive story numbers. The counter is kept in
+        redis, the project row only records the last reserved number, which
+        seeds the counter when redis lost it.
+        :return: the first reserved number
+        """
+        query_set = Project.objects.filter(pk=self.pk)
+        if not settings.REDIS_URL:
+            query_set.select_for_update().update(
+                story_counter=models.F('story_counter') + count
+            )
+            self.story_counter = query_set.values_list(
+                'story_counter', flat=True
+            )[0]
+            return self.story_counter - count + 1
+        from ..api.notify import get_redis
+        r = get_redis()
+        key = story_numbers_key(self.pk)
+        last = r.eval(INCR_STORY_NUMBERS, 1, key, count)
+        if last is None:
+            counter, max_number = query_set.annotate(
+                max_number=models.Max('stories__number')
+            ).values_list('story_counter', 'max_number')[0]
+            r.setnx(key, max(counter or 0, max_number or 0))
+            last = r.incrby(key, count)
+        query_set.filter(
+            models.Q(story_counter__isnull=True) |
+            models.Q(story_counter__lt=last)
+        ).update(story_counter=last)
+        self.story_counter = last
+        return last - count + 1
+
+    def next_story_number(self):
+        """
+        Next story number, taken from a block of STORY_NUMBER_BLOCK numbers
+        reserved by this process. Numbers left in a block when the process
+        ends are lost.
+        """
+        if not settings.REDIS_URL:
+            # a block reserved in the database would be given back by a
+            # rollback while this process still hands out its numbers
+            return self.reserve_story_numbers(1)
+        lock = story_numbers_locks.setdefault(self.pk, threading.Lock())
+        with lock:
+            numbers = story_numbers.get(self.pk)
+            if numbers and numbers[0] <= numbers[1]:
+                numbers[0] += 1
+                return numbers[0] - 1
+        block = settings.STORY_NUMBER_BLOCK
+        first = self.reserve_story_numbers(block)
+        with lock:
+            # a block reserved meanwhile by another thread is left as a gap
+            story_numbers[self.pk] = [first + 1, first + block - 1]
+        return first
+
     def __unicode__(self):
         return self.name
 
@@ -442,11 +670,19 @@ class Project(StatsMixin, WithThemeMixin, AclMixin, models.Model):
         AuthorizationAssociation.objects.filter(
             user=user, project=self
         ).delete()
+        invalidate_acl("project", self.pk)
 
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = re.sub('[\W]*', '', self.name)[:5].upper()
-        return super(Project, self).save(*args, **kwargs)
+        created = not self.pk
+        result = super(Project, self).save(*args, **kwargs)
+        if created:
+            # a recycled primary key must not inherit a stale ACL
+            invalidate_acl("project", self.pk)
+            invalidate_statistic_series(self.pk)
+            forget_story_numbers(self.pk)
+        return result
 
     def all_as_a(self):
         result = self.stories.values_list('as_a', flat=True).distinct()
@@ -469,51 +705,118 @@ class Project(StatsMixin, WithThemeMixin, AclMixin, models.Model):
         if not day:
             day = timezone.now()
 
-        data = dict()
-
-        def constant_factory():
-            return {
-                'stories': 0,
-                'points': 0,
-                'non_estimated': 0,
-            }
-
-        def populate(stories):
-            result = constant_factory()
-            result['by_status'] = defaultdict(constant_factory)
-            for s in stories.all():
-                bs = result['by_status'][s.status]
-                result['stories'] += 1
-                bs['stories'] += 1
-                if s.points > 0:
-                    result['points'] += int(s.points)
-                    bs['points'] += int(s.points)
-                elif s.points == -1:
-                    result['non_estimated'] += 1
-            return result
-
-        data['all'] = populate(self.stories)
-        if self.main_backlog:
-            data['main'] = populate(self.main_backlog.stories)
+        data = self.statistic_counters_data()
         data['backlogs'] = self.backlogs.count()
         # check if statistics are the same as previous one
         # if it is the case, do not create object
-        if self.statistics.exists():
-            prev = self.statistics.latest("day")
-            if prev.data == data:
-                return None, False
+        latest = self.statistics.order_by("-day").values_list(
+            "digest", flat=True)[:1]
+        if latest and latest[0] == statistic_digest(data):
+            return None, False
         statistics, create = Statistic.objects.get_or_create(
             project=self, day=day)
         statistics.data = data
         statistics.save()
         return statistics, create
 
+    def rebuild_statistic_counters(self):
+        """
+        Compute the statistic counters from all project stories, to be done
+        only once as counters are then updated at each story change.
+        """
+        main_backlog_id = self.main_backlog.pk if self.main_backlog else None
+        counters = dict()
+
+        def counter(scope, status):
+            if (scope, status) not in counters:
+                counters[(scope, status)] = StatisticCounter(
+                    project=self, scope=scope, status=status)
+            return counters[(scope, status)]
+
+        for scope in StatisticCounter.SCOPES:
+            for status, name in STATUS_CHOICE:
+                counter(scope, status)
+        for backlog_id, status, points in self.stories.values_list(
+                "backlog_id", "status", "points"):
+            scopes = [StatisticCounter.ALL]
+            if backlog_id == main_backlog_id:
+                scopes.append(StatisticCounter.MAIN)
+            for scope in scopes:
+                counter(scope, status).add_story(points)
+        try:
+            with transaction.atomic():
+                self.reset_statistic_counters()
+                StatisticCounter.objects.bulk_create(counters.values())
+        except IntegrityError:
+            # created meanwhile by a concurrent rebuild
+            return list(self.statistic_counters.all())
+        return counters.values()
+
+    def reset_statistic_counters(self):
+        """
+        Drop statistic counters, they will be re-built when needed
+        """
+        StatisticCounter.objects.filter(project=self).delete()
+
+    def statistic_counters_data(self):
+        counters = list(self.statistic_counters.all())
+        if not counters:
+            counters = self.rebuild_statistic_counters()
+        data = dict()
+        for scope in StatisticCounter.SCOPES:
+            data[scope] = {
+                'stories': 0,
+                'points': 0,
+                'non_estimated': 0,
+                'by_status': dict(),
+            }
+        for c in counters:
+            if c.stories:
+                result = data[c.scope]
+                values = {
+                    'stories': c.stories,
+                    'points': c.points,
+                    'non_estimated': c.non_estimated,
+                }
+                result['by_status'][c.status] = values
+                for k, v in values.items():
+                    result[k] += v
+        if not self.main_backlog:
+            del data[StatisticCounter.MAIN]
+        return data
+
     def compact_statistics(self):
+        """
+        Removes the statistics having the same data as the next day ones,
+        comparing their digests so that the JSON data is never loaded.
+        """
+        for s in self.statistics.filter(digest=EMPTY).iterator():
+            s.save(update_fields=("digest",))
+        duplicates = []
         prev = None
-        for s in self.statistics.all():
-            if prev and prev.same_data(s):
-                s.delete()
-            prev = s
+        for pk, digest in self.statistics.values_list(
+                "pk", "digest").iterator():
+            if digest == prev:
+                duplicates.append(pk)
+            prev = digest
+        for i in range(0, len(duplicates), STATISTIC_DELETE_BATCH):
+            Statistic.objects.filter(
+                pk__in=duplicates[i:i + STATISTIC_DELETE_BATCH]).delete()
+        if duplicates:
+            invalidate_statistic_series(self.pk)
+
+    def statistic_series(self):
+        """
+        Daily statistics of the project stored by columns, see
+        build_statistic_series, they are cached until a statistic changes.
+        """
+        key = statistic_series_cache_key(self.pk)
+        series = cache.get(key)
+        if series is None:
+            series = build_statistic_series(
+                self.statistics.only("day", "data"))
+            cache.set(key, series, settings.STATISTIC_SERIES_CACHE_TIMEOUT)
+        return series
 
     def restore(self):
         self.is_archive = False
@@ -545,10 +848,37 @@ class Backlog(StatsMixin, WithThemeMixin, models.Model):
     auto_status = models.CharField(_("Auto status"), max_length=20, blank=True,
                                    choices=STATUS_CHOICE, default="")
     is_main = models.BooleanField(_("Main"), default=False)
+    revision = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ("order",)
 
+    def __init__(self, *args, **kwargs):
+        super(Backlog, self).__init__(*args, **kwargs)
+        self._was_main = self.__dict__.get('is_main')
+
+    def is_main_of(self, project_id):
+        """
+        Tell if this is the main backlog of the project, the main backlog of
+        an organization is never the main one of its projects
+        """
+        return self.is_main and self.project_id == project_id
+
+    def save(self, *args, **kwargs):
+        result = super(Backlog, self).save(*args, **kwargs)
+        if self.project_id and self.is_main != self._was_main:
+            # main backlog statistics must be computed again
+            self.project.reset_statistic_counters()
+        self._was_main = self.is_main
+        return result
+
+    def delete(self, using=None):
+        project_ids = list(self.stories.values_list(
+            "project_id", flat=True).distinct())
+        DeletedStory.record(self.stories.all())
+        super(Backlog, self).delete(using)
+        StatisticCounter.objects.filter(project_id__in=project_ids).delete()
+
     @property
     def ordered_stories(self):
         return self.stories.order_by('order').prefetch_related(
@@ -563,9 +893,60 @@ class Backlog(StatsMixin, WithThemeMixin, models.Model):
     @property
     def end_position(self):
         if not hasattr(self, "_end_pos"):
-            self._end_pos = self.stories.count()
+            max_order = self.stories.aggregate(
+                models.Max('order'))['order__max']
+            if max_order is None:
+                self._end_pos = STORY_ORDER_GAP
+            else:
+                self._end_pos = max_order + STORY_ORDER_GAP
         return self._end_pos
 
+    def move_story(self, story, order):
+        """
+        Place 'story' (already in this backlog) at its index in 'order'.
+        Only the story key is written when a gap remains between its new
+        neighbours, else the whole backlog is re-numbered with gaps.
+        :return: (touched, neighbours), neighbours is the (previous pk,
+        next pk) tuple of the story, or None when the backlog had to be
+        re-numbered
+        """
+        current = list(self.stories.order_by(
+            "order", "pk").values_list("pk", "order"))
+        result = sparse_position(current, order, story.pk)
+        if result is None:
+            touched = reorder(self.stories.all(), order,
+                              start=STORY_ORDER_GAP, step=STORY_ORDER_GAP)
+            return touched, None
+        position, previous, following = result
+        touched = position != story.order
+        if touched:
+            story.order = position
+            story.save(update_fields=('order',))
+        return touched, (previous, following)
+
+    def append_story(self, story):
+        """
+        Place 'story' (already in this backlog) after the other stories.
+        :return: the (previous pk, next pk) neighbours of the story
+        """
+        previous = self.stories.exclude(pk=story.pk).order_by(
+            "-order").values_list("pk", flat=True)[:1]
+        story.order = self.end_position
+        story.save(update_fields=('order',))
+        return previous[0] if previous else None, None
+
+    def next_revision(self):
+        """
+        Increments the revision of the backlog stories order, notified with
+        each move so that clients can detect the moves they missed.
+        :return: the new revision
+        """
+        Backlog.objects.filter(pk=self.pk).update(
+            revision=models.F("revision") + 1)
+        self.revision = Backlog.objects.filter(pk=self.pk).values_list(
+            "revision", flat=True)[0]
+        return self.revision
+
     def __unicode__(self):
         return self.name
 
@@ -620,6 +1001,9 @@ class Backlog(StatsMixin, WithThemeMixin, models.Model):
         return not (self.is_archive or self.is_main)
 
 
+STATISTIC_STATE_FIELDS = ("project_id", "backlog_id", "status", "points")
+
+
 class UserStory(models.Model):
 
     FIBONACCI_CHOICE = (
@@ -655,23 +1039,24 @@ class UserStory(models.Model):
     status = models.CharField(_("Status"), max_length=20, default=Status.TODO,
                               choices=STATUS_CHOICE)
     code = models.CharField(_("Code"), max_length=20, null=False, blank=False)
+    modified = models.DateTimeField(_("Modified"), auto_now=True,
+                                    default=timezone.now)
     # DOT NOT PUT META ORDERING HERE it will break the distinct theme
     # fetching !
 
-    @transaction.commit_on_success
+    class Meta:
+        index_together = (("project", "modified"),)
+
+    def __init__(self, *args, **kwargs):
+        super(UserStory, self).__init__(*args, **kwargs)
+        self._counted_state = self.statistic_state()
+
     def setup_number(self):
         """
         Create an unique number for this story based on project counter
         """
         if not self.number:
-            query_set = Project.objects.filter(pk=self.project.pk)
-            query_set.select_for_update().update(
-                story_counter=models.F('story_counter')+1
-            )
-            self.project.story_counter = query_set.values_list(
-                'story_counter', flat=True
-            )[0]
-            self.number = self.project.story_counter
+            self.number = self.project.next_story_number()
             if not self.code:
                 self.code = self.get_initial_code()
 
@@ -680,7 +1065,79 @@ class UserStory(models.Model):
 
     def save(self, *args, **kwargs):
         self.setup_number()
-        return super(UserStory, self).save(*args, **kwargs)
+        if self._state.adding:
+            old_state = None
+        else:
+            old_state = self._counted_state or self.stored_statistic_state()
+        # the order is not part of the payload nor a modification of the
+        # story, order changes touch the backlog themselves
+        update_fields = kwargs.get("update_fields")
+        changed = not update_fields or set(update_fields) - set(["order"])
+        if update_fields and changed:
+            kwargs['update_fields'] = tuple(update_fields) + ("modified",)
+        result = super(UserStory, self).save(*args, **kwargs)
+        new_state = self.statistic_state() or self.stored_statistic_state()
+        if old_state and new_state and old_state != new_state and \
+                old_state[1] == new_state[1]:
+            # same backlog, whether it is the main one is read only once
+            is_main = new_state[2]
+            if is_main is None:
+                is_main = old_state[2]
+            if is_main is None:
+                is_main = self.backlog.is_main_of(self.project_id)
+            old_state = old_state[:2] + (is_main,) + old_state[3:]
+            new_state = new_state[:2] + (is_main,) + new_state[3:]
+        StatisticCounter.story_changed(old_state, new_state)
+        self._counted_state = new_state
+        if changed:
+            invalidate_story_payloads(self.pk)
+            self.touch_backlog()
+        return result
+
+    def delete(self, using=None):
+        state = self.statistic_state() or self.stored_statistic_state()
+        pk = self.pk
+        DeletedStory.record([self])
+        super(UserStory, self).delete(using)
+        StatisticCounter.story_changed(state, None)
+        invalidate_story_payloads(pk)
+        self.touch_backlog()
+
+    def touch_backlog(self):
+        """
+        Update the last modification of the backlog, its stories changed
+        """
+        Backlog.objects.filter(pk=self.backlog_id).update(
+            last_modified=timezone.now())
+
+    def statistic_state(self):
+        """
+        Values the story statistics depend on, None if some are deferred:
+        (project_id, backlog_id, is_main, status, points). Whether the
+        backlog is the main one of the project is only known when it is
+        loaded, else None.
+        """
+        try:
+            project_id, backlog_id, status, points = (
+                self.__dict__[k] for k in STATISTIC_STATE_FIELDS)
+        except KeyError:
+            return None
+        backlog = self.__dict__.get("_backlog_cache")
+        if backlog is not None and backlog.pk == backlog_id:
+            is_main = backlog.is_main_of(project_id)
+        else:
+            is_main = None
+        return project_id, backlog_id, is_main, status, points
+
+    def stored_statistic_state(self):
+        values = UserStory.objects.filter(pk=self.pk).values_list(
+            "project_id", "backlog_id", "backlog__is_main",
+            "backlog__project_id", "status", "points")
+        if not values:
+            return None
+        project_id, backlog_id, is_main, owner_id, status, points = values[0]
+        return (project_id, backlog_id, is_main and owner_id == project_id,
+                status, points)
 
     @property
     def text(self):
@@ -745,6 +1202,29 @@ def user_notification_count(self):
 get_model(*User.split('.', 1)).notification_count = user_notification_count
 
 
+class DeletedStory(models.Model):
+    """
+    Tombstone of a deleted story, for the clients synchronizing the changes
+    of a project.
+    """
+    project = models.ForeignKey(Project, verbose_name=_("Project"),
+                                related_name="deleted_stories")
+    story_id = models.IntegerField(_("Story"))
+    backlog_id = models.IntegerField(_("Backlog"), null=True)
+    deleted = models.DateTimeField(_("Deleted"), default=timezone.now)
+
+    class Meta:
+        index_together = (("project", "deleted"),)
+
+    @classmethod
+    def record(cls, stories):
+        cls.objects.bulk_create([
+            cls(project_id=s.project_id, story_id=s.pk,
+                backlog_id=s.backlog_id)
+            for s in stories if s.pk
+        ])
+
+
 class Event(models.Model):
     user = models.ForeignKey(User, verbose_name=_("User"),
                              related_name="events")
@@ -772,14 +1252,84 @@ class Event(models.Model):
         ordering = ("-when",)
 
 
+STATISTIC_DELETE_BATCH = 500
+
+
+def statistic_digest(data):
+    """
+    :return: the sha1 of the canonical JSON representation of the data
+    """
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, separators=(",", ":"))
+    ).hexdigest()
+
+
+def statistic_series_cache_key(project_pk):
+    return "backlogman.statistic_series:{0}".format(project_pk)
+
+
+def invalidate_statistic_series(project_pk):
+    cache.delete(statistic_series_cache_key(project_pk))
+
+
+# Version of the cached API payload of the stories, to be increased when the
+# serialized story fields change.
+STORY_PAYLOAD_VERSION = 1
+
+
+def story_payload_cache_key(story_pk):
+    return "backlogman.story_payload:{0}:{1}".format(STORY_PAYLOAD_VERSION,
+                                                     story_pk)
+
+
+def invalidate_story_payloads(*pks):
+    delete_cached([story_payload_cache_key(pk) for pk in pks if pk])
+
+
+def build_statistic_series(statistics):
+    """
+    Walks the statistics once and stores them by columns.
+    :param statistics: the statistics, most recent first
+    :return: a dict with the 'days' javascript timestamps, the points of
+    each status per day for 'all' the project and its 'main' backlog, and
+    the 'latest' statistic data
+    """
+    series = {
+        'days': [],
+        'latest': None,
+    }
+    for scope in StatisticCounter.SCOPES:
+        series[scope] = dict((s[0], []) for s in STATUS_CHOICE)
+    for statistic in statistics:
+        if series['latest'] is None:
+            series['latest'] = statistic.data
+        series['days'].append(statistic.js_date)
+        for scope in StatisticCounter.SCOPES:
+            by_status = statistic.data.get(scope, {}).get('by_status', {})
+            for status, values in series[scope].items():
+                values.append(by_status.get(status, {}).get('points') or 0)
+    return series
+
+
 class Statistic(models.Model):
     project = models.ForeignKey(Project, verbose_name=_("Project"),
                                 related_name="statistics")
     day = models.DateField(_("Day"), default=timezone.now)
     data = JSONField(_("Data"))
+    digest = models.CharField(_("Digest"), max_length=40, blank=True)
 
     class Meta:
         ordering = ("-day",)
+        index_together = (("project", "digest"),)
+
+    def save(self, *args, **kwargs):
+        self.digest = statistic_digest(self.data)
+        super(Statistic, self).save(*args, **kwargs)
+        invalidate_statistic_series(self.project_id)
+
+    def delete(self, *args, **kwargs):
+        super(Statistic, self).delete(*args, **kwargs)
+        invalidate_statistic_series(self.project_id)
 
     @property
     def js_date(self):
@@ -805,10 +1355,101 @@ class Statistic(models.Model):
 
     def same_data(self, other):
         if other:
+            if self.digest and other.digest:
+                return other.digest == self.digest
             return other.data == self.data
         return False
 
 
+class StatisticCounter(models.Model):
+    """
+    Running story counters of a project by status, for the whole project
+    and for its main backlog. They are updated at each story change so that
+    daily statistics do not have to go through all the stories.
+    """
+    ALL = "all"
+    MAIN = "main"
+    SCOPES = (ALL, MAIN)
+
+    project = models.ForeignKey(Project, verbose_name=_("Project"),
+                                related_name="statistic_counters")
+    scope = models.CharField(_("Scope"), max_length=8)
+    status = models.CharField(_("Status"), max_length=20,
+                              choices=STATUS_CHOICE)
+    stories = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+    non_estimated = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (("project", "scope", "status"),)
+
+    def __unicode__(self):
+        return u"<StatisticCounter - {0} {1}:{2}>".format(
+            self.project_id, self.scope, self.status)
+
+    @staticmethod
+    def story_values(points):
+        return {
+            'stories': 1,
+            'points': int(points) if points > 0 else 0,
+            'non_estimated': 1 if points == -1 else 0,
+        }
+
+    def add_story(self, points):
+        for k, v in StatisticCounter.story_values(points).items():
+            setattr(self, k, getattr(self, k) + v)
+
+    @classmethod
+    def story_changed(cls, old_state, new_state):
+        """
+        Move a story contribution from 'old_state' to 'new_state', both are
+        UserStory.statistic_state() tuples or None.
+        Nothing is counted for projects without counters, they are computed
+        from scratch when first needed.
+        """
+        if old_state == new_state:
+            return
+        if old_state:
+            cls._count_story(old_state, -1)
+        if new_state:
+            cls._count_story(new_state, 1)
+
+    @classmethod
+    def stories_added(cls, states):
+        """
+        Count new stories with one update by backlog and status, 'states'
+        are UserStory.statistic_state() tuples.
+        """
+        totals = dict()
+        for project_id, backlog_id, is_main, status, points in states:
+            values = totals.setdefault((project_id, backlog_id, is_main,
+                                        status),
+                                       dict(stories=0, points=0,
+                                            non_estimated=0))
+            for k, v in cls.story_values(points).items():
+                values[k] += v
+        for key, values in totals.items():
+            cls._add_values(key, values)
+
+    @classmethod
+    def _count_story(cls, state, sign):
+        project_id, backlog_id, is_main, status, points = state
+        cls._add_values((project_id, backlog_id, is_main, status), dict(
+            (k, sign * v) for k, v in cls.story_values(points).items()
+        ))
+
+    @classmethod
+    def _add_values(cls, key, values):
+        project_id, backlog_id, is_main, status = key
+        if is_main is None:
+            is_main = Backlog.objects.filter(
+                pk=backlog_id, project_id=project_id, is_main=True).exists()
+        scopes = [cls.ALL, cls.MAIN] if is_main else [cls.ALL]
+        cls.objects.filter(
+            project_id=project_id, scope__in=scopes, status=status
+        ).update(**dict((k, models.F(k) + v) for k, v in values.items()))
+
+
 def build_event_kwargs(values, **kwargs):
     """
     :param values: dictionary
@@ -838,3 +1479,115 @@ def create_event(user, text, project=None, backlog=None, story=None,
         story=story,
         organization=organization,
     ))
+
+
+def reordered_positions(current, order, start=0, step=1):
+    """
+    :param current: iterable of (pk, position) in the current order
+    :param order: list of pks in the wished order
+    :param start: position of the first item
+    :param step: distance between two consecutive positions
+    :return: dictionary pk -> new position for the rows that must move
+    Items not listed in 'order' are placed after the listed ones, keeping
+    their current relative order.
+    """
+    index = dict()
+    for pk in order:
+        index.setdefault(pk, len(index))
+    end_index = len(index)
+    result = dict()
+    for pk, position in current:
+        new_index = index.get(pk, None)
+        if new_index is None:
+            new_index = end_index
+            end_index += 1
+        new_position = start + new_index * step
+        if new_position != position:
+            result[pk] = new_position
+    return result
+
+
+def sparse_position(current, order, moved):
+    """
+    :param current: list of (pk, position) in the current order
+    :param order: list of pks in the wished order, containing 'moved'
+    :param moved: pk of the moved item
+    :return: (position, previous pk, next pk) placing 'moved' between its new
+    neighbours, or None if the other items are not in the wished order or if
+    there is no gap left between the neighbours.
+    """
+    positions = dict(current)
+    if moved not in order or moved not in positions:
+        return None
+    others = [pk for pk, position in current if pk != moved]
+    listed = []
+    seen = set()
+    for pk in order:
+        if pk in positions and pk not in seen:
+            seen.add(pk)
+            listed.append(pk)
+    before = listed.index(moved)
+    listed.remove(moved)
+    if listed != others[:len(listed)]:
+        return None
+    previous = others[before - 1] if before > 0 else None
+    following = others[before] if before < len(others) else None
+    low = positions[previous] if previous is not None else -1
+    position = positions[moved]
+    if following is None:
+        if position <= low:
+            position = low + STORY_ORDER_GAP
+    else:
+        high = positions[following]
+        if not low < position < high:
+            if high - low < 2:
+                return None
+            position = (low + high) // 2
+    return position, previous, following
+
+
+# Each row of the bulk order update uses three query parameters, keep the
+# statement below the 999 parameters limit of sqlite.
+BULK_ORDER_CHUNK = 300
+
+
+def bulk_update_order(model, positions, field="order"):
+    """
+    Write all the new positions (dictionary pk -> position) of 'model' rows
+    with a single UPDATE ... CASE statement per BULK_ORDER_CHUNK rows.
+    """
+    if not positions:
+        return
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    sql = "UPDATE {0} SET {1} = CASE {2} {{0}} END WHERE {2} IN ({{1}})"
+    sql = sql.format(
+        qn(model._meta.db_table),
+        qn(model._meta.get_field(field).column),
+        qn(model._meta.pk.column),
+    )
+    items = sorted(positions.items())
+    cursor = connection.cursor()
+    for i in range(0, len(items), BULK_ORDER_CHUNK):
+        chunk = items[i:i + BULK_ORDER_CHUNK]
+        params = []
+        for pk, position in chunk:
+            params.extend((pk, position))
+        params.extend(pk for pk, position in chunk)
+        cursor.execute(sql.format(
+            " ".join(["WHEN %s THEN %s"] * len(chunk)),
+            ", ".join(["%s"] * len(chunk)),
+        ), params)
+
+
+def reorder(queryset, order, field="order", start=0, step=1):
+    """
+    Re-order the objects of 'queryset' following the pks listed in 'order'
+    :return: True if at least one object position changed
+    """
+    positions = reordered_positions(
+        queryset.order_by(field, "pk").values_list("pk", field), order,
+        start, step
+    )
+    bulk_update_order(queryset.model, positions, field)
+    return bool(positions)
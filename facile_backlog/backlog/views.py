@@ -24,7 +24,7 @@ from django.views.decorators.csrf import csrf_protect
 
 from .models import (Project, Backlog, UserStory, AuthorizationAssociation,
                      create_event, Organization, status_for, STATUS_COLORS,
-                     Status)
+                     Status, prefetch_stats)
 from .forms import (ProjectCreationForm, ProjectEditionForm,
                     BacklogCreationForm, BacklogEditionForm,
                     StoryEditionForm, StoryCreationForm, InviteUserForm,
@@ -237,9 +237,9 @@ class OrgDetail(OrgMixin, generic.DetailView):
         context['archived_projects'] = self.organization.projects.filter(
             is_archive=True
         ).order_by("-last_modified")
-        backlogs = self.organization.backlogs.order_by(
+        backlogs = prefetch_stats(self.organization.backlogs.order_by(
             "-is_main", "is_archive", "order"
-        ).all()
+        ))
         context['backlogs'] = backlogs
         context['archived_count'] = len(
             [b for b in backlogs if b.is_archive]
@@ -434,9 +434,9 @@ class OrgBacklogs(OrgMixin, generic.TemplateView):
         ).select_related("project").order_by("project__name")
         context['projects_with_main'] = [b.project for b in backlogs.all()]
 
-        backlogs = self.organization.backlogs.filter(
+        backlogs = prefetch_stats(self.organization.backlogs.filter(
             is_archive=False
-        ).select_related("project").all()
+        ).select_related("project"))
         context['backlog_list'] = backlogs
         context['backlog_width'] = 320 * (max(len(backlogs)+1, 2))
         context['ws_url'] = get_websocket_url(self.request)
@@ -779,9 +779,9 @@ class ProjectDetail(ProjectMixin, generic.DetailView):
                 d.absolute_url = self.request.build_absolute_uri(
                     reverse("project_dashboard", args=(d.slug,)))
             context['dashboards'] = dashboards
-        backlogs = self.project.backlogs.order_by(
+        backlogs = prefetch_stats(self.project.backlogs.order_by(
             "-is_main", "is_archive", "order"
-        ).all()
+        ))
         context['backlogs'] = backlogs
         context['archived_count'] = len(
             [b for b in backlogs if b.is_archive]
@@ -976,8 +976,8 @@ class ProjectBacklogs(ProjectMixin, generic.TemplateView):
     def get_context_data(self, **kwargs):
         context = super(ProjectBacklogs, self).get_context_data(**kwargs)
         context['project'] = self.project
-        context['backlog_list'] = [b for b in self.project.backlogs.all()
-                                   if not b.is_archive]
+        context['backlog_list'] = prefetch_stats(
+            self.project.backlogs.filter(is_archive=False))
         context['ws_url'] = get_websocket_url(self.request)
         return context
 project_backlogs = login_required(ProjectBacklogs.as_view())
@@ -996,42 +996,31 @@ class ProjectStats(ProjectMixin, generic.TemplateView):
         context = super(ProjectStats, self).get_context_data(**kwargs)
         context['project'] = self.project
 
-        base = list(self.project.statistics.all()[:self.days])
-        if not base:
+        series = self.project.statistic_series()
+        if not series['days']:
             return context
+        days = series['days'][:self.days]
 
-        def compute_series(name, call):
+        def compute_series(scope, name):
             return {
                 'name': status_for(name),
                 'color': STATUS_COLORS[name],
-                'data': [s.time_series(call) for s in base],
+                'data': zip(days, series[scope][name]),
             }
 
-        context['all_points'] = [
-            compute_series(Status.TODO, "all.by_status.to_do.points"),
-            compute_series(Status.IN_PROGRESS,
-                           "all.by_status.in_progress.points"),
-            compute_series(Status.COMPLETED, "all.by_status.completed.points"),
-            compute_series(Status.REJECTED, "all.by_status.rejected.points"),
-            compute_series(Status.ACCEPTED, "all.by_status.accepted.points"),
-        ]
-
-        context['main_points'] = [
-            compute_series(Status.TODO, "main.by_status.to_do.points"),
-            compute_series(Status.IN_PROGRESS,
-                           "main.by_status.in_progress.points"),
-            compute_series(Status.COMPLETED,
-                           "main.by_status.completed.points"),
-            compute_series(Status.REJECTED, "main.by_status.rejected.points"),
-            compute_series(Status.ACCEPTED, "main.by_status.accepted.points"),
-        ]
-
-        s = base[0]
-        if 'main' in s.data:
+        statuses = (Status.TODO, Status.IN_PROGRESS, Status.COMPLETED,
+                    Status.REJECTED, Status.ACCEPTED)
+        context['all_points'] = [compute_series("all", name)
+                                 for name in statuses]
+        context['main_points'] = [compute_series("main", name)
+                                  for name in statuses]
+
+        latest = series['latest']
+        if 'main' in latest:
             context['main_status_pie'] = [pie_element(k, v) for k, v in
-                                          s.data['main']['by_status'].items()]
+                                          latest['main']['by_status'].items()]
         context['project_status_pie'] = [pie_element(k, v) for k, v in
-                                         s.data['all']['by_status'].items()]
+                                         latest['all']['by_status'].items()]
 
         return context
 project_stats = login_required(ProjectStats.as_view())
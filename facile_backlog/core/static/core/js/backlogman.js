@@ -102,4 +102,89 @@
 			$item.data("_flash_to", to)
 		};
 	}
+
+	// Users present on the websocket channel, set by the "presence" snapshots
+	// (sent on join, then periodically when several processes share the
+	// presence) and updated by the "user_join" / "user_leave" deltas. Returns
+	// the sorted present users, or null if the message is not about presence.
+	var ws_users = {};
+	$.apply_presence = function(message) {
+		if (message.type == "presence") {
+			ws_users = {};
+			message.users.forEach(function(u) {
+				ws_users[u] = true;
+			});
+		} else if (message.type == "user_join") {
+			ws_users[message.user] = true;
+		} else if (message.type == "user_leave") {
+			delete ws_users[message.user];
+		} else {
+			return null;
+		}
+		return Object.keys(ws_users).sort();
+	};
+
+	// Apply a "stories_moved" notification to the 'selector' story elements
+	// of the $parent container. The message holds either the full 'order' of
+	// the backlog, or only the moved story new neighbours. Story containers
+	// keep the 'backlog-revision' they show, a missed revision triggers a
+	// resync of the whole container.
+	$.apply_stories_moved = function($parent, selector, message) {
+		var story = function(pk) {
+			return $(selector+"[story-id="+pk+"]");
+		};
+		// returns false if the container missed a previous revision
+		var follows = function($container, revision) {
+			var known = parseInt($container.attr("backlog-revision"), 10);
+			if (!isNaN(known) && revision <= known) {
+				return true;
+			}
+			$container.attr("backlog-revision", revision);
+			return isNaN(known) || revision == known + 1;
+		};
+		if (message.source_backlog_id) {
+			var $source = $("[story-backlog-id="+message.source_backlog_id+"]");
+			if ($source.length && !follows($source, message.source_revision)) {
+				$.resync_stories($source, selector);
+			}
+		}
+		if (!$parent.length) {
+			return;
+		}
+		if (message.order) {
+			follows($parent, message.revision);
+			for (var i in message.order) {
+				$parent.append(story(message.order[i]));
+			}
+		} else if (!follows($parent, message.revision)) {
+			$.resync_stories($parent, selector);
+		} else if (message.moved_story_id) {
+			var $moved = story(message.moved_story_id);
+			var $previous = $parent.find(story(message.previous_story_id));
+			var $next = $parent.find(story(message.next_story_id));
+			if ($previous.length) {
+				$previous.after($moved);
+			} else if ($next.length) {
+				$next.before($moved);
+			} else if (message.previous_story_id) {
+				$parent.append($moved);
+			} else {
+				$parent.prepend($moved);
+			}
+		}
+	};
+
+	// Order the story elements of the $parent container as given by the
+	// stories API at its 'backlog-stories-url'.
+	$.resync_stories = function($parent, selector) {
+		var url = $parent.attr("backlog-stories-url");
+		if (!url) {
+			return;
+		}
+		$.getJSON(url, function(stories) {
+			for (var i in stories) {
+				$parent.append($(selector+"[story-id="+stories[i].id+"]"));
+			}
+		});
+	};
  }(jQuery));
\ No newline at end of file
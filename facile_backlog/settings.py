@@ -11,6 +11,10 @@ from django.core.urlresolvers import reverse_lazy
 SECRET_KEY = os.environ['SECRET_KEY']
 
 EASYBACKLOG_TOKEN = os.getenv("EASYBACKLOG_TOKEN", "")
+EASYBACKLOG_API_URL = os.getenv("EASYBACKLOG_API_URL",
+                                "https://easybacklog.com/api/")
+# concurrent API requests of the easy_import command
+EASYBACKLOG_IMPORT_THREADS = 8
 
 DEBUG = (os.environ.get('DEBUG', "False").lower() not in [
     'false', 'no', 'none'])
@@ -209,6 +213,30 @@ CACHES = {
     },
 }
 
+# Project and organization ACLs are shared through the cache, they are
+# invalidated on authorization changes, the timeout is only a safety net.
+ACL_CACHE_TIMEOUT = 60 * 60
+
+# Column stored statistics of a project, invalidated when a statistic of the
+# project is saved or compacted.
+STATISTIC_SERIES_CACHE_TIMEOUT = 24 * 60 * 60
+
+# API payload of each story, invalidated when the story is saved or deleted.
+STORY_PAYLOAD_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Story numbers are reserved in redis by blocks of STORY_NUMBER_BLOCK per
+# process and project, the numbers of a block not used when the process ends
+# are lost. Without REDIS_URL each number is reserved in the database.
+STORY_NUMBER_BLOCK = 50
+
+# Realtime notifications are published to redis by a background thread,
+# the outbox holds at most NOTIFICATION_OUTBOX_SIZE pending requests, a
+# failed publish is retried NOTIFICATION_RETRIES times, waiting
+# NOTIFICATION_RETRY_DELAY seconds doubled at each retry.
+NOTIFICATION_OUTBOX_SIZE = 1000
+NOTIFICATION_RETRIES = 3
+NOTIFICATION_RETRY_DELAY = 0.2
+
 # Sentry
 
 if 'SENTRY_DSN' in os.environ:
@@ -243,6 +271,21 @@ API_THROTTLE = "100/m"
 
 WEBSOCKET_URL = os.environ.get("WEBSOCKET_URL", "ws://localhost:8081/ws/")
 WEBSOCKET_PORT = os.environ.get("WEBSOCKET_PORT", "8001")
+# The socket metrics of each websocket process are served on localhost only,
+# on WEBSOCKET_METRICS_PORT plus the process number, not at all when empty.
+WEBSOCKET_METRICS_PORT = os.environ.get("WEBSOCKET_METRICS_PORT", "8011")
+
+# The websocket users are resolved from their session by a pool of
+# WEBSOCKET_AUTH_THREADS threads, out of the IOLoop, and cached by session
+# key for WEBSOCKET_SESSION_CACHE_TIMEOUT seconds.
+WEBSOCKET_AUTH_THREADS = 4
+WEBSOCKET_SESSION_CACHE_TIMEOUT = 30
+WEBSOCKET_SESSION_CACHE_SIZE = 10000
+
+# Websockets are pinged every WEBSOCKET_PING_INTERVAL seconds and closed
+# when silent for WEBSOCKET_PING_TIMEOUT seconds.
+WEBSOCKET_PING_INTERVAL = 30
+WEBSOCKET_PING_TIMEOUT = 75
 
 GOOGLE_SITE_VERIFY = os.environ.get("GOOGLE_SITE_VERIFY", "")
 
@@ -19,8 +19,9 @@ from django.db import transaction
 
 
 from ..backlog.views import NoCacheMixin, ProjectMixin
-from ..backlog.models import create_event
-from ..api.notify import notify_changes
+from ..backlog.models import (create_event, reordered_positions,
+                              bulk_update_order)
+from ..api.notify import notify_changes, notify_after_commit
 from ..util import get_websocket_url
 
 from models import (StoryMap, Story, Theme, Phase)
@@ -198,6 +199,7 @@ ORDER = "order"
 
 @api_view(["POST"])
 @parser_classes((JSONParser,))
+@notify_after_commit
 @transaction.commit_on_success
 def story_map_action(request, story_map_id):
     story_map = get_object_or_404(StoryMap, pk=story_map_id)
@@ -257,11 +259,11 @@ def story_map_action(request, story_map_id):
             event_text = _("updated story map's '%s'") % (target,)
             if order:
                 order = [int(x) for x in order]
-                for item in model_class.objects.filter(pk__in=order).all():
-                    index = order.index(item.pk)
-                    if item.order != index:
-                        item.order = index
-                        item.save()
+                bulk_update_order(model_class, reordered_positions(
+                    model_class.objects.filter(
+                        pk__in=order).values_list("pk", "order"),
+                    order
+                ))
                 event_text = _("re-order story map's '%s'") % (target,)
         elif action == DELETE:
             obj = model_class.objects.get(pk=target_id)
@@ -269,11 +271,11 @@ def story_map_action(request, story_map_id):
             event_text = _("deleted story map's '%s'") % (target,)
         elif action == ORDER:
             order = [int(x) for x in content['order']]
-            for item in model_class.objects.filter(pk__in=order).all():
-                index = order.index(item.pk)
-                if item.order != index:
-                    item.order = index
-                    item.save()
+            bulk_update_order(model_class, reordered_positions(
+                model_class.objects.filter(
+                    pk__in=order).values_list("pk", "order"),
+                order
+            ))
             event_text = _("re-order story map's '%s'") % (target,)
         else:
             return Response({
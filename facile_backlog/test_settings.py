@@ -13,6 +13,9 @@ DATABASES = {
 
 API_THROTTLE = None
 
+# the in-memory test database is not shared with other threads
+WEBSOCKET_AUTH_THREADS = 0
+
 # Don't bother with PBKDF2 in tests. This saves a **lot** of time.
 PASSWORD_HASHERS = [
     'tests.hashers.NotHashingHasher',
@@ -1,30 +1,83 @@
 import json
 import logging
 import datetime
+import threading
+import time
+import uuid
 
-from collections import defaultdict
+from collections import defaultdict, Counter
+from multiprocessing.pool import ThreadPool
 
+from tornado.concurrent import Future
 from tornado.gen import coroutine, Task
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import RequestHandler
 from tornado.websocket import WebSocketHandler
 
 from django.conf import settings
 from django.contrib import auth
+from django.db import close_old_connections
 from django.utils import importlib
 
 import tornadoredis
 
 CLIENTS = defaultdict(set)
 
+# Messages waiting for the next IOLoop iteration, by channel key, as a list
+# of (message, skipped client) tuples.
+PENDING = defaultdict(list)
+flush_scheduled = False
+
 REDIS_RETRY_CONNECT = 5
-WEBSOCKET_GARBAGE_CHECK = 20
 
 NOTIFICATION_CHANNEL = "realtime_notif"
 REDIS_DB = 2
 
+# Sockets of each user by channel key, as channel key -> Counter(email), a
+# user with several tabs opened is present once.
+PRESENCE = defaultdict(Counter)
+
+# When several processes serve the websockets, the users present on each
+# channel are also kept in a redis hash shared by the processes, with one
+# "process token|email" field per process and present user, and presence
+# messages are published on the channel of the key to reach the other
+# processes. Each process records in the PRESENCE_PROCESSES hash until when
+# its fields are valid, refreshed by keepalive: the fields of a process
+# which stopped, or of a previous run, are ignored and removed. Keepalive also
+# sends the shared users again to every client, as a full snapshot.
+PRESENCE_KEY = "presence:{0}"
+PRESENCE_PROCESSES = "presence-processes"
+PRESENCE_TIMEOUT = 24 * 60 * 60
+
+# Users resolved from the session keys, as session key -> (expiry, user),
+# shared by the authentication threads
+SESSION_USERS = {}
+session_users_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 client = None
+presence_client = None
+process_id = None
+process_token = None
+auth_pool = None
+keepalive_callback = None
+
+counters = {
+    'opened': 0,
+    'closed': 0,
+    'timed_out': 0,
+}
+
+
+def channel_models():
+    from facile_backlog.backlog.models import Organization, Project
+    from facile_backlog.storymap.models import StoryMap
+    return {
+        'projects': Project,
+        'organizations': Organization,
+        'storymap': StoryMap,
+    }
 
 
 def on_redis_message(message):
@@ -32,31 +85,65 @@ def on_redis_message(message):
         try:
             io_loop = IOLoop.instance()
             data = json.loads(message.body)
-            key = data['key']
-            message = data['data']
+            if message.channel == NOTIFICATION_CHANNEL:
+                key = data['key']
+                data = data['data']
+            else:
+                key = message.channel
             io_loop.add_callback(write_to_clients, src_client=key,
-                                 data=message)
+                                 data=data)
         except Exception:
             logger.warn(
                 "Received wrong message from redis {0}".format(message))
     elif message.kind == 'disconnect':
         logger.info("Disconected from redis subscriber")
         listen()
-    elif message.kind == 'subscribe':
+    elif message.kind in ('subscribe', 'unsubscribe'):
         pass
     else:
         logger.debug("Received unknown message {0}".format(message))
 
 
+def listening():
+    return client is not None and bool(client.subscribed)
+
+
+def subscribe(key):
+    """
+    Subscribe to the channel of the key, once it has its first client.
+    """
+    if listening():
+        client.subscribe(key)
+
+
+def unsubscribe(key):
+    """
+    Unsubscribe from the channel of the key, once it has no client left.
+    """
+    if listening():
+        client.unsubscribe(key)
+
+
+def redis_client():
+    host, _, port = settings.REDIS_URL.partition(":")
+    return tornadoredis.Client(host=host, port=int(port),
+                               selected_db=REDIS_DB)
+
+
 @coroutine
 def listen():
     global client
-    host, _, port = settings.REDIS_URL.partition(":")
-    client = tornadoredis.Client(host=host, port=int(port),
-                                 selected_db=REDIS_DB)
+    client = redis_client()
     try:
         client.connect()
-        yield Task(client.subscribe, NOTIFICATION_CHANNEL)
+        # the global channel keeps the listener alive while no client is
+        # connected, each key with clients has its own channel
+        keys = [k for k, c in CLIENTS.items() if c]
+        yield Task(client.subscribe, [NOTIFICATION_CHANNEL] + keys)
+        # keys which got their first client while subscribing
+        missed = [k for k, c in CLIENTS.items() if c and k not in keys]
+        if missed:
+            client.subscribe(missed)
         client.listen(on_redis_message)
     except tornadoredis.ConnectionError as ex:
         logger.info(
@@ -66,61 +153,399 @@ def listen():
         ), listen)
 
 
-@coroutine
-def garbager():
-    try:
-        for k, c_list in CLIENTS.items():
-            new_list = set([c for c in c_list if c.ws_connection is not None])
-            CLIENTS[k] = new_list
-            for c in c_list - new_list:
-                logger.info(u"Disconnected {0}".format(c))
-                _client_removed(c)
-    finally:
-        IOLoop.instance().add_timeout(datetime.timedelta(
-            seconds=WEBSOCKET_GARBAGE_CHECK
-        ), garbager)
+def keepalive():
+    """
+    Ping the clients, closing the ones which did not answer nor send
+    anything for WEBSOCKET_PING_TIMEOUT seconds.
+    """
+    now = time.time()
+    for clients in CLIENTS.values():
+        for c in list(clients):
+            if now - c.last_seen > settings.WEBSOCKET_PING_TIMEOUT:
+                logger.info(u"Timed out {0}".format(c))
+                counters['timed_out'] += 1
+                c.close()
+            elif c.ws_connection:
+                c.ping("")
+    if presence_client:
+        refresh_presence()
+        resend_presence()
+
+
+def socket_metrics():
+    """
+    :return: the live sockets by channel key and the socket counters
+    """
+    channels = dict((k, len(c)) for k, c in CLIENTS.items())
+    return dict(counters, sockets=sum(channels.values()),
+                channels=channels)
+
+
+def start_listener(shared_process_id=None):
+    """
+    :param shared_process_id: stable id of this process when several
+    processes serve the websockets, presence is then shared through redis
+    """
+    global presence_client, process_id, process_token
+    if shared_process_id is not None:
+        process_id = shared_process_id
+        # the presence of a previous run of the process is not renewed
+        process_token = "{0}-{1}".format(process_id, uuid.uuid4().hex[:8])
+        presence_client = redis_client()
+        presence_client.connect()
+        refresh_presence()
+    listen()
+    start_keepalive()
 
 
-def start_listener():
-    listen()
-    garbager()
+def start_keepalive():
+    global keepalive_callback
+    if keepalive_callback is None:
+        keepalive_callback = PeriodicCallback(
+            keepalive, settings.WEBSOCKET_PING_INTERVAL * 1000)
+        keepalive_callback.start()
+
+
+def refresh_presence():
+    """
+    Keep the presence fields of this process valid until the next keepalive
+    """
+    presence_client.hset(PRESENCE_PROCESSES, process_token,
+                         time.time() + settings.WEBSOCKET_PING_TIMEOUT)
 
 
 def append_client(client):
     key = client.client_key
+    if not CLIENTS.get(key):
+        subscribe(key)
     CLIENTS[key].add(client)
-    write_to_clients(client, json.dumps({
-        'type': "user_join",
-        'user': client.user.email,
-        'users': [c.user.email for c in CLIENTS[key] if c.user]
-    }))
+    counters['opened'] += 1
+    join_presence(client)
 
 
 def remove_client(client):
+    """
+    Remove the client from its channel, the channel is evicted with its last
+    client. Removing a client twice does nothing.
+    """
+    key = client.client_key
+    clients = CLIENTS.get(key)
+    if clients is None or client not in clients:
+        return
+    clients.discard(client)
+    if not clients:
+        del CLIENTS[key]
+        unsubscribe(key)
+    counters['closed'] += 1
+    leave_presence(client)
+
+
+def join_presence(client):
+    """
+    The joining client receives the users present on the channel, the other
+    clients are only told about the user if it was not already present.
+    """
+    key = client.client_key
+    email = client.user.email
+    users = PRESENCE[key]
+    users[email] += 1
+    first = users[email] == 1
+    if presence_client:
+        share_presence(client, "user_join" if first else None)
+        return
+    send_presence(client)
+    if first:
+        write_to_clients(client, presence_delta("user_join", email),
+                         self_notify=False)
+
+
+def leave_presence(client):
+    """
+    The other clients are told about the leave of the user once its last
+    socket on the channel is closed.
+    """
     key = client.client_key
-    CLIENTS[key].discard(client)
-    _client_removed(client)
+    email = client.user.email
+    users = PRESENCE.get(key)
+    if users is None or not users[email]:
+        return
+    users[email] -= 1
+    if users[email]:
+        return
+    del users[email]
+    if not users:
+        del PRESENCE[key]
+    if presence_client:
+        share_presence(client, "user_leave")
+    else:
+        write_to_clients(key, presence_delta("user_leave", email))
+
+
+def presence_delta(kind, email):
+    return json.dumps({
+        'type': kind,
+        'user': email,
+    })
+
+
+def presence_snapshot(users):
+    return json.dumps({
+        'type': "presence",
+        'users': sorted(users),
+    })
+
+
+def live_fields(fields, processes, now=None):
+    """
+    :param fields: the redis presence hash of a channel
+    :param processes: the PRESENCE_PROCESSES hash
+    :return: the fields of the processes whose presence is still valid
+    """
+    now = now or time.time()
+    return dict((f, c) for f, c in fields.items()
+                if float(processes.get(f.partition("|")[0], 0)) > now)
 
 
-def _client_removed(client):
+def shared_users(fields):
+    """
+    :return: the emails of the users present in the redis presence hash
+    """
+    return set(f.partition("|")[2] for f, c in fields.items() if int(c) > 0)
+
+
+@coroutine
+def resend_presence():
+    """
+    Send again the shared users of each channel to all its clients, the users
+    of a stopped process or whose delta was missed do not stay listed.
+    """
+    keys = list(CLIENTS)
+    if not keys:
+        return
+    try:
+        pipe = presence_client.pipeline()
+        pipe.hgetall(PRESENCE_PROCESSES)
+        for key in keys:
+            pipe.hgetall(PRESENCE_KEY.format(key))
+        results = yield Task(pipe.execute)
+    except Exception as ex:
+        logger.warn(u"Unable to resend presence: {0}".format(ex))
+        return
+    processes = results[0]
+    now = time.time()
+    for key, fields in zip(keys, results[1:]):
+        write_to_clients(key, presence_snapshot(shared_users(
+            live_fields(fields, processes, now))))
+
+
+def send_presence(client):
+    """
+    Send the users present on the channel to the client only.
+    """
+    if presence_client:
+        share_presence(client)
+    else:
+        client.write_message(presence_snapshot(PRESENCE.get(
+            client.client_key, ())))
+
+
+@coroutine
+def share_presence(client, kind=None):
+    """
+    Record the join or leave of the user of the client in the presence shared
+    by the processes, publishing the delta if no other process has the user
+    present. The joining client receives the shared users.
+    :param kind: "user_join", "user_leave" or None to only send the users
+    """
     key = client.client_key
-    write_to_clients(client, json.dumps({
-        'type': "user_leave",
-        'user': client.user.email,
-        'users': [c.user.email for c in CLIENTS[key] if c.user]
-    }))
+    redis_key = PRESENCE_KEY.format(key)
+    email = client.user.email
+    field = "{0}|{1}".format(process_token, email)
+    try:
+        pipe = presence_client.pipeline()
+        if kind == "user_join":
+            pipe.hset(redis_key, field, 1)
+            pipe.expire(redis_key, PRESENCE_TIMEOUT)
+        elif kind == "user_leave":
+            pipe.hdel(redis_key, field)
+        pipe.hgetall(redis_key)
+        pipe.hgetall(PRESENCE_PROCESSES)
+        results = yield Task(pipe.execute)
+        fields, processes = results[-2], results[-1]
+        now = time.time()
+        live = live_fields(fields, processes, now)
+        dead = [f for f in fields if f not in live]
+        expired = [t for t, e in processes.items() if float(e) <= now]
+        if dead or expired:
+            # swept before anything is sent, the next reads never see them
+            pipe = presence_client.pipeline()
+            if dead:
+                pipe.hdel(redis_key, *dead)
+            if expired:
+                pipe.hdel(PRESENCE_PROCESSES, *expired)
+            yield Task(pipe.execute)
+        users = shared_users(live)
+        if kind != "user_leave" and client.ws_connection:
+            client.write_message(presence_snapshot(users))
+        others = [f for f in live if f != field and
+                  f.partition("|")[2] == email]
+        if kind and not others:
+            yield Task(presence_client.publish, key,
+                       presence_delta(kind, email))
+    except Exception as ex:
+        logger.warn(u"Unable to share presence on {0}: {1}".format(key, ex))
+
+
+def run_in_thread(func, *args):
+    """
+    Run the blocking function in the authentication thread pool, the result
+    is set on the returned future from the IOLoop thread. The function runs
+    inline when WEBSOCKET_AUTH_THREADS is 0.
+    """
+    global auth_pool
+    future = Future()
+    if not settings.WEBSOCKET_AUTH_THREADS:
+        try:
+            future.set_result(func(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+    if auth_pool is None:
+        auth_pool = ThreadPool(settings.WEBSOCKET_AUTH_THREADS)
+    io_loop = IOLoop.instance()
+
+    def call():
+        # results go through the callback, exceptions included
+        close_old_connections()
+        try:
+            return future.set_result, func(*args)
+        except Exception as ex:
+            return future.set_exception, ex
+        finally:
+            close_old_connections()
+
+    def done(result):
+        io_loop.add_callback(*result)
+    auth_pool.apply_async(call, callback=done)
+    return future
+
+
+def session_user(session_key):
+    """
+    :return: the authenticated user of the session or None, cached for
+    WEBSOCKET_SESSION_CACHE_TIMEOUT seconds by session key.
+    """
+    now = time.time()
+    with session_users_lock:
+        cached = SESSION_USERS.get(session_key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    # get_user needs a django request object, but only looks at the session
+    class Dummy(object):
+        pass
+    engine = importlib.import_module(settings.SESSION_ENGINE)
+    django_request = Dummy()
+    django_request.session = engine.SessionStore(session_key)
+    user = auth.get_user(django_request)
+    if not user.is_authenticated():
+        user = None
+    with session_users_lock:
+        if len(SESSION_USERS) >= settings.WEBSOCKET_SESSION_CACHE_SIZE:
+            for key in [k for k, (e, u) in SESSION_USERS.items()
+                        if e <= now]:
+                del SESSION_USERS[key]
+            if len(SESSION_USERS) >= settings.WEBSOCKET_SESSION_CACHE_SIZE:
+                SESSION_USERS.clear()
+        SESSION_USERS[session_key] = (
+            now + settings.WEBSOCKET_SESSION_CACHE_TIMEOUT, user)
+    return user
+
+
+def can_join(user, obj_type, obj_id):
+    """
+    :return: True if the user can read the object of the channel.
+    """
+    model = channel_models().get(obj_type)
+    if model is None:
+        return False
+    try:
+        obj = model.objects.get(pk=obj_id)
+    except model.DoesNotExist:
+        return False
+    return obj.can_read(user)
+
+
+def resolve_client(session_key, obj_type, obj_id, user=None):
+    """
+    Blocking resolution of the user of a websocket, run outside of the
+    IOLoop thread.
+    :return: the user if allowed to join the channel, None otherwise
+    """
+    if user is None and session_key:
+        user = session_user(session_key)
+    if user is None or not can_join(user, obj_type, obj_id):
+        return None
+    return user
+
+
+def superseded_by(message):
+    """
+    :return: a function telling if a pending message is made useless by the
+    given message, or None if the message supersedes nothing. A full order
+    of backlog stories or of backlogs replaces the previous moves.
+    """
+    if not isinstance(message, dict) or 'order' not in message:
+        return None
+    if message.get('type') == "stories_moved":
+        return lambda m: (m.get('type') == "stories_moved" and
+                          m.get('backlog_id') == message.get('backlog_id'))
+    if message.get('type') == "backlogs_moved":
+        return lambda m: m.get('type') == "backlogs_moved"
+    return None
 
 
 def write_to_clients(src_client, data, self_notify=True):
+    """
+    Queue the message for the clients of the channel, queues are flushed at
+    the next IOLoop iteration.
+    """
     logger.debug("Write to client {0} -> {1}".format(src_client, data))
-    if isinstance(src_client, SocketHandler):
-        key = src_client.client_key
-    else:
+    if isinstance(src_client, basestring):
         key = src_client
-    for c in CLIENTS[key]:
-        if c.ws_connection:
-            if self_notify or c != src_client:
-                c.write_message(data)
+    else:
+        key = src_client.client_key
+    skipped = None if self_notify else src_client
+    queue = PENDING[key]
+    superseded = superseded_by(data)
+    if superseded:
+        queue[:] = [(m, s) for m, s in queue
+                    if not (isinstance(m, dict) and superseded(m))]
+    queue.append((data, skipped))
+    global flush_scheduled
+    if not flush_scheduled:
+        flush_scheduled = True
+        IOLoop.instance().add_callback(flush_clients)
+
+
+def flush_clients():
+    """
+    Writes the queued messages, each payload is serialized once for all the
+    clients of the channel.
+    """
+    global flush_scheduled
+    flush_scheduled = False
+    while PENDING:
+        key, queue = PENDING.popitem()
+        clients = [c for c in CLIENTS.get(key, ()) if c.ws_connection]
+        for data, skipped in queue:
+            if not clients:
+                break
+            if not isinstance(data, basestring):
+                data = json.dumps(data)
+            for c in clients:
+                if c != skipped:
+                    c.write_message(data)
 
 
 class SocketHandler(WebSocketHandler):
@@ -135,49 +560,76 @@ class SocketHandler(WebSocketHandler):
             self.request.headers.get("Origin", "unknown")
         )
 
+    @coroutine
     def open(self, obj_type,  obj_id):
-        self.user = self.get_current_user()
+        self.user = None
+        self.last_seen = time.time()
+        # messages received while the user is resolved
+        self._early_messages = []
         self.obj_type = obj_type
         self.obj_id = obj_id
         self.client_key = "{0}:{1}".format(self.obj_type, self.obj_id)
 
-        if not self.user:
+        try:
+            user = yield self.get_current_user()
+        except Exception:
+            logger.exception(u"Unable to resolve the websocket user")
+            user = None
+        if not self.ws_connection:
+            # closed while resolving
+            return
+        if not user:
             self.close()
             return
-            # raise Exception("Not logged in")
+        self.user = user
         logger.info(u"Opening {0}".format(self))
         append_client(self)
+        for message in self._early_messages:
+            self.on_message(message)
+        self._early_messages = []
 
-    def on_closed(self):
+    def on_close(self):
         logger.debug("closing")
         remove_client(self)
 
+    def close(self):
+        # tornado does not call on_close when the server closes the socket
+        if self.ws_connection:
+            super(SocketHandler, self).close()
+        remove_client(self)
+
+    def on_pong(self, data):
+        self.last_seen = time.time()
+
     def on_message(self, message):
+        self.last_seen = time.time()
+        if not self.user:
+            self._early_messages.append(message)
+            return
         data = json.loads(message)
+        if data.get('type') == "presence":
+            send_presence(self)
+            return
         data['username'] = self.user.full_name if self.user else "anonymous"
         write_to_clients(self, data)
 
-    def get_django_session(self):
-        if not hasattr(self, '_session'):
-            engine = importlib.import_module(
-                settings.SESSION_ENGINE)
-            session_key = self.get_cookie(
-                settings.SESSION_COOKIE_NAME)
-            self._session = engine.SessionStore(session_key)
-        return self._session
-
     def get_current_user(self):
-        if self._test_user:
-            return self._test_user
-
-        # get_user needs a django request object, but only looks at the session
-        class Dummy(object):
-            pass
-        django_request = Dummy()
-        django_request.session = self.get_django_session()
-        user = auth.get_user(django_request)
-        if user.is_authenticated():
-            return user
-        else:
-             # try api token auth
-            return None
+        """
+        :return: a future resolving to the user of the session, or None if
+        not logged in or not allowed to read the object of the channel.
+        """
+        return run_in_thread(
+            resolve_client,
+            self.get_cookie(settings.SESSION_COOKIE_NAME),
+            self.obj_type, self.obj_id, self._test_user
+        )
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Live sockets by channel, served on a port of its own bound to localhost,
+    see main_tornado.py.
+    """
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(socket_metrics()))
@@ -1,15 +1,19 @@
 import logging
 import logging.config
+import socket
 
 import tornado.options
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.options import options, define
+from tornado.process import fork_processes
 from tornado.web import Application
 
 from django.conf import settings
 
-from facile_backlog.websockets import (SocketHandler, start_listener)
+from facile_backlog.websockets import (SocketHandler, MetricsHandler,
+                                       start_listener)
 
 logging.config.dictConfig(settings.LOGGING)
 
@@ -18,20 +22,60 @@ logger = logging.getLogger(__name__)
 ws_port = settings.WEBSOCKET_PORT
 
 define('port', type=int, default=ws_port)
+define('processes', type=int, default=1,
+       help="number of server processes, 0 for one per CPU")
+define('metrics_port', type=int,
+       default=int(settings.WEBSOCKET_METRICS_PORT or 0),
+       help="metrics port of the first process, on localhost only, "
+            "0 to disable")
 tornado.options.parse_command_line()
 
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
+
+def bind_reuse_port(port, backlog=128):
+    """
+    Listening socket of the current process only, the kernel balances the
+    connections between the processes bound to the same port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind(("", port))
+    sock.listen(backlog)
+    return [sock]
+
 
 def main():
 
     logger = logging.getLogger(__name__)
+    process_id = None
+    if options.processes == 1:
+        sockets = bind_sockets(options.port)
+    elif SO_REUSEPORT is None:
+        # sockets are shared by the forked processes
+        sockets = bind_sockets(options.port)
+        process_id = fork_processes(options.processes)
+    else:
+        process_id = fork_processes(options.processes)
+        sockets = bind_reuse_port(options.port)
     tornado_app = Application(
         [
             (r'/ws/(?P<obj_type>[\w]+)/(?P<obj_id>[\d]+)/$', SocketHandler),
         ], debug=False)
-    start_listener()
-    logger.info("Tornado websocket server started on port {0}".format(ws_port))
+    if options.metrics_port:
+        # never reachable through the public port nor a local proxy
+        metrics_app = Application([
+            (r'/ws/metrics/$', MetricsHandler),
+        ], debug=False)
+        metrics_app.listen(options.metrics_port + (process_id or 0),
+                           address="127.0.0.1")
+    start_listener(shared_process_id=process_id)
+    logger.info("Tornado websocket server started on port {0}".format(
+        options.port))
     server = HTTPServer(tornado_app)
-    server.listen(options.port)
+    server.add_sockets(sockets)
     try:
         IOLoop.instance().start()
     except KeyboardInterrupt:
@@ -0,0 +1,256 @@
+"""
+Websocket load test, opens many concurrent sockets on a running
+main_tornado.py, publishes notifications at a given rate and reports the
+fan-out latency, the delivered messages per second and the server memory.
+
+    envdir envdir python tests/bench_websocket.py --clients=2000 \
+        --channels=20 --rate=50 --duration=30 --server-pid=<tornado pid>
+
+The sockets are authenticated by the session of a benchmark user, created
+with its projects in the database of the settings, which the tornado server
+must read too: point both at a throw-away database. Only the objects created
+by the benchmark are removed at the end, an existing benchmark user is kept.
+--spawn-redis starts a throw-away redis server on --redis-port, the
+tornado server must then use the same REDIS_URL.
+"""
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "facile_backlog.settings")
+
+import tornado.options  # noqa
+from tornado.ioloop import IOLoop, PeriodicCallback  # noqa
+from tornado.options import options, define  # noqa
+
+from django.conf import settings  # noqa
+
+define('url', type=str, default="ws://localhost:{0}/ws/".format(
+    settings.WEBSOCKET_PORT), help="websocket url of the server")
+define('clients', type=int, default=1000, help="number of sockets")
+define('channels', type=int, default=10,
+       help="number of projects the sockets are spread on")
+define('rate', type=float, default=20,
+       help="notifications published per second")
+define('duration', type=float, default=20,
+       help="seconds of notifications, once all the sockets are opened")
+define('connect_batch', type=int, default=100,
+       help="sockets opened at each IOLoop iteration")
+define('server_pid', type=int, default=None,
+       help="pid of the tornado server, to report its memory")
+define('spawn_redis', type=bool, default=False,
+       help="start a redis server for the benchmark")
+define('redis_port', type=int, default=6399)
+
+from facile_backlog.api import notify  # noqa
+
+import websocket  # noqa
+
+logger = logging.getLogger(__name__)
+
+BENCH_EMAIL = "websocket-bench@example.com"
+
+
+class Stats(object):
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+        self.expected = 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def server_rss(pid):
+    """
+    :return: the resident memory of the process in MB, or None
+    """
+    if pid is None:
+        return None
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        out = subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)])
+        return int(out.strip()) / 1024.0
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def setup_data(channels):
+    """
+    :return: the session of the benchmark user, its project ids and the user
+    if it was created by the benchmark, else None
+    """
+    from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+    from django.utils import importlib
+    from facile_backlog.backlog.models import (AuthorizationAssociation,
+                                               Project)
+    from facile_backlog.core.models import User
+    user, created = User.objects.get_or_create(email=BENCH_EMAIL, defaults={
+        'full_name': "Websocket bench",
+    })
+    projects = []
+    for i in range(channels):
+        project = Project.objects.create(
+            name=u"Websocket bench {0}".format(i),
+            code="B{0}".format(i),
+        )
+        AuthorizationAssociation.objects.create(
+            project=project, user=user, is_active=True, is_admin=False)
+        projects.append(project.pk)
+    engine = importlib.import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = user.pk
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session.save()
+    return session, projects, user if created else None
+
+
+def cleanup_data(session, projects, user):
+    from facile_backlog.backlog.models import Project
+    session.delete()
+    Project.objects.filter(pk__in=projects).delete()
+    if user is not None:
+        user.delete()
+
+
+def run(session_key, projects):
+    io_loop = IOLoop.instance()
+    stats = Stats()
+    sockets = []
+    cookie = {'Cookie': "{0}={1}".format(settings.SESSION_COOKIE_NAME,
+                                         session_key)}
+    by_channel = dict((pk, 0) for pk in projects)
+
+    class BenchSocket(websocket.WebSocket):
+        def on_open(self):
+            stats.opened += 1
+
+        def on_message(self, data):
+            message = json.loads(data)
+            if message.get('type') == "bench":
+                stats.received += 1
+                stats.latencies.append(time.time() - message['sent'])
+
+    def connect(remaining):
+        for i in range(min(options.connect_batch, remaining)):
+            pk = projects[(remaining - i) % len(projects)]
+            by_channel[pk] += 1
+            ws = BenchSocket("{0}projects/{1}/".format(options.url, pk),
+                             io_loop, cookie)
+            ws.stream.set_close_callback(on_closed)
+            sockets.append(ws)
+        remaining -= options.connect_batch
+        if remaining > 0:
+            io_loop.add_callback(connect, remaining)
+        else:
+            wait_opened(time.time())
+
+    def on_closed():
+        stats.closed += 1
+
+    def wait_opened(start):
+        if stats.opened + stats.closed < options.clients and \
+                time.time() - start < 60:
+            io_loop.add_timeout(time.time() + 0.1,
+                                lambda: wait_opened(start))
+            return
+        logger.info(u"{0} socket(s) opened, {1} closed".format(
+            stats.opened, stats.closed))
+        report["rss_idle"] = server_rss(options.server_pid)
+        publisher.start()
+        io_loop.add_timeout(time.time() + options.duration, stop)
+
+    def publish():
+        pk = random.choice(projects)
+        notify.notify_changes("projects", pk, {
+            'type': "bench",
+            'sent': time.time(),
+        })
+        stats.sent += 1
+        stats.expected += by_channel[pk]
+
+    def stop():
+        publisher.stop()
+        report["rss_loaded"] = server_rss(options.server_pid)
+        # let the last notifications arrive
+        io_loop.add_timeout(time.time() + 2, io_loop.stop)
+
+    report = {}
+    publisher = PeriodicCallback(publish, 1000.0 / options.rate)
+    io_loop.add_callback(connect, options.clients)
+    io_loop.start()
+    for ws in sockets:
+        ws.stream.set_close_callback(None)
+        if not ws.stream.closed():
+            ws.stream.close()
+    return stats, report
+
+
+def print_report(stats, report):
+    latencies = [l * 1000 for l in stats.latencies]
+    print "sockets: {0} opened, {1} closed by the server".format(
+        stats.opened, stats.closed)
+    print "notifications: {0} sent, {1}/{2} delivered ({3:.1f}%)".format(
+        stats.sent, stats.received, stats.expected,
+        100.0 * stats.received / stats.expected if stats.expected else 0.0)
+    print "messages/s: {0:.1f}".format(stats.received / options.duration)
+    print "latency ms: p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, " \
+          "max {3:.1f}".format(percentile(latencies, 50),
+                               percentile(latencies, 90),
+                               percentile(latencies, 99),
+                               max(latencies) if latencies else 0.0)
+    if report.get("rss_idle") is not None:
+        print "server RSS MB: {0:.1f} connected, {1:.1f} loaded, " \
+              "{2:.1f} KB/socket".format(
+                  report["rss_idle"], report["rss_loaded"],
+                  report["rss_idle"] * 1024 / stats.opened
+                  if stats.opened else 0.0)
+
+
+def main():
+    tornado.options.parse_command_line()
+    redis_server = None
+    if options.spawn_redis:
+        redis_server = subprocess.Popen([
+            "redis-server", "--port", str(options.redis_port),
+            "--save", "", "--appendonly", "no"])
+        settings.REDIS_URL = "localhost:{0}".format(options.redis_port)
+        time.sleep(0.5)
+    limit = raise_file_limit()
+    if limit < options.clients + 100:
+        logger.warn(u"Open files limited to {0}".format(limit))
+    session, projects, user = setup_data(options.channels)
+    try:
+        stats, report = run(session.session_key, projects)
+        print_report(stats, report)
+    finally:
+        cleanup_data(session, projects, user)
+        if redis_server:
+            redis_server.terminate()
+
+
+if __name__ == '__main__':
+    main()
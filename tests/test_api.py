@@ -1,11 +1,22 @@
+import calendar
 import json
+import mock
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.signals import request_finished
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
 
-from .factories import (UserFactory, create_sample_project,
+from .factories import (UserFactory, BacklogFactory, create_sample_project,
                         create_project_sample_backlog, create_sample_story,
                         OrganizationFactory, create_sample_organization)
 
-from facile_backlog.backlog.models import UserStory
+from facile_backlog.backlog.models import (UserStory, Status, Backlog,
+                                           story_payload_cache_key)
 
 from . import JsonTestCase
 
@@ -63,6 +74,82 @@ class APITestRead(JsonTestCase):
         self.assertJsonKeyEqual(response, 'name', "My backlog")
         self.assertJsonKeyEqual(response, 'id', backlog.pk)
 
+    def test_api_project_statistics(self):
+        user = UserFactory.create(email="test@test.ch")
+        wrong_user = UserFactory.create()
+        story = create_sample_story(user, story_kwargs={
+            'points': 5,
+            'status': Status.TODO,
+        })
+        project = story.project
+        project.generate_daily_statistics(
+            day=timezone.now() - timedelta(days=1))
+        story.status = Status.ACCEPTED
+        story.save()
+        project.generate_daily_statistics()
+
+        url = reverse("api_project_statistics", args=(project.pk,))
+        self.client.get(url, status=401)
+        self.client.get(url, status=404, user=wrong_user)
+        response = self.client.get(url, user=user)
+        self.assertEqual(len(response.json['days']), 2)
+        self.assertEqual(response.json['all'][Status.TODO], [0, 5])
+        self.assertEqual(response.json['all'][Status.ACCEPTED], [5, 0])
+        self.assertEqual(response.json['main'][Status.ACCEPTED], [0, 0])
+        response = self.client.get("{0}?days=1".format(url), user=user)
+        self.assertEqual(len(response.json['days']), 1)
+        self.assertEqual(response.json['all'][Status.ACCEPTED], [5])
+
+    def test_api_project_changes(self):
+        user = UserFactory.create(email="test@test.ch")
+        wrong_user = UserFactory.create()
+        backlog = create_project_sample_backlog(user)
+        project = backlog.project
+        other = BacklogFactory.create(project=project)
+        moved, deleted, kept = [
+            create_sample_story(user, backlog=backlog) for i in range(3)]
+        dropped = create_sample_story(user, backlog=other)
+        past = timezone.now() - timedelta(hours=1)
+        UserStory.objects.update(modified=past)
+        Backlog.objects.update(last_modified=past)
+        since = calendar.timegm(past.utctimetuple()) + 60
+
+        url = reverse("api_project_changes", args=(project.pk,))
+        self.client.get(url, status=401)
+        self.client.get(url, {'since': since}, status=404, user=wrong_user)
+        self.client.get(url, {'since': "yesterday"}, status=400, user=user)
+        for invalid in ("1e20", "-1e20", "nan", "inf"):
+            response = self.client.get(url, {'since': invalid}, status=400,
+                                       user=user)
+            self.assertEqual(response.json, {
+                'errors': ["Missing or invalid 'since' timestamp"]})
+        response = self.client.get(url, {'since': since}, user=user)
+        self.assertEqual(response.json['changed'], [])
+        self.assertEqual(response.json['backlogs'], [])
+
+        # re-ordered stories are not changed, only their backlog
+        self.client.post(reverse("api_move_story"), data=json.dumps({
+            'target_backlog': backlog.pk,
+            'order': [kept.pk, moved.pk, deleted.pk],
+            'moved_story': kept.pk,
+        }), user=user, content_type="application/json")
+        response = self.client.get(url, {'since': since}, user=user)
+        self.assertEqual(response.json['changed'], [])
+        self.assertEqual(response.json['backlogs'], [backlog.pk])
+
+        third = BacklogFactory.create(project=project)
+        moved.move_to(third)
+        deleted_pks = sorted([deleted.pk, dropped.pk])
+        deleted.delete()
+        other.delete()
+        response = self.client.get(url, {'since': since}, user=user)
+        self.assertEqual(response.json['changed'], [moved.pk])
+        self.assertEqual(response.json['deleted'], deleted_pks)
+        self.assertEqual(response.json['backlogs'],
+                         sorted([backlog.pk, third.pk]))
+        self.assertGreater(response.json['until'], since)
+        self.assertNotIn(kept.pk, response.json['changed'])
+
 
 class APITest_Story(JsonTestCase):
     def test_story_list(self):
@@ -87,6 +174,91 @@ class APITest_Story(JsonTestCase):
             "http://testserver/api/backlogs/1/stories/1/"
         )
 
+    def test_story_list_cache(self):
+        user = UserFactory.create(email="test@test.ch")
+        story = create_sample_story(user)
+        create_sample_story(user, backlog=story.backlog)
+        url = reverse("api_stories", args=(story.backlog.pk,))
+        response = self.client.get(url, user=user)
+        with mock.patch("rest_framework.serializers.BaseSerializer."
+                        "to_native") as to_native:
+            cached = self.client.get(url, user=user)
+        self.assertFalse(to_native.called)
+        self.assertEqual(cached.json, response.json)
+
+        # a payload cached again before the commit is dropped at the end
+        # of the request
+        key = story_payload_cache_key(story.pk)
+        stale = cache.get(key)
+        story.as_a = "cache user"
+        story.save()
+        cache.set(key, stale)
+        request_finished.send(sender=self.__class__)
+        self.assertIsNone(cache.get(key))
+        response = self.client.get(url, user=user)
+        data = dict((s['id'], s) for s in response.json)
+        self.assertEqual(data[story.pk]['as_a'], "cache user")
+        story.project.lang = "fr"
+        story.project.save()
+        response = self.client.get(url, user=user)
+        self.assertEqual([s['lang'] for s in response.json], ["fr", "fr"])
+
+    def test_story_list_pages(self):
+        user = UserFactory.create(email="test@test.ch")
+        backlog = create_project_sample_backlog(user)
+        stories = [create_sample_story(user, backlog=backlog,
+                                       story_kwargs={'order': i})
+                   for i in range(5)]
+        url = reverse("api_stories", args=(backlog.pk,))
+        response = self.client.get(url, {'limit': 2, 'fields': "code"},
+                                   user=user)
+        self.assertEqual(response.json, [
+            {'id': s.pk, 'code': s.code} for s in stories[:2]])
+        pages = [response.json]
+        while 'Link' in response:
+            next_url = response['Link'].split(";")[0][1:-1]
+            response = self.client.get(next_url, user=user)
+            pages.append(response.json)
+        self.assertEqual([[s['id'] for s in p] for p in pages],
+                         [[s.pk for s in stories[i:i + 2]]
+                          for i in range(0, 5, 2)])
+        self.client.get(url, {'fields': "code,unknown"}, user=user,
+                        status=400)
+        self.client.get(url, {'limit': 2, 'cursor': "wrong"}, user=user,
+                        status=400)
+
+    def test_story_list_not_modified(self):
+        user = UserFactory.create(email="test@test.ch")
+        story = create_sample_story(user)
+        url = reverse("api_stories", args=(story.backlog.pk,))
+        # the backlog may still change within the same second
+        modified = Backlog.objects.get(pk=story.backlog_id).last_modified
+        with mock.patch("django.utils.timezone.now", return_value=modified):
+            response = self.client.get(url, user=user)
+            self.assertNotIn('Last-Modified', response)
+            self.client.get(url, user=user, status=200,
+                            HTTP_IF_MODIFIED_SINCE=http_date(
+                                calendar.timegm(modified.utctimetuple())))
+        Backlog.objects.filter(pk=story.backlog_id).update(
+            last_modified=timezone.now() - timedelta(minutes=1))
+        response = self.client.get(url, user=user)
+        etag = response['ETag']
+        self.client.get(url, user=user, status=304,
+                        HTTP_IF_NONE_MATCH=etag)
+        self.client.get(url, user=user, status=304,
+                        HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        # another selection of the same backlog
+        self.client.get(url, {'fields': "code"}, user=user, status=200,
+                        HTTP_IF_NONE_MATCH=etag)
+        Backlog.objects.filter(pk=story.backlog_id).update(
+            last_modified=timezone.now() - timedelta(days=1))
+        response = self.client.get(url, user=user)
+        etag = response['ETag']
+        story.status = Status.ACCEPTED
+        story.save()
+        self.client.get(url, user=user, status=200,
+                        HTTP_IF_NONE_MATCH=etag)
+
     def test_story_detail(self):
         user = UserFactory.create(email="test@test.ch")
         wrong_user = UserFactory.create()
@@ -137,6 +309,73 @@ class APITest_Story(JsonTestCase):
         self.assertEqual(story.so_i_can, 'create user story using API')
         self.assertEqual(story.theme, 'api')
 
+    def test_story_bulk(self):
+        user = UserFactory.create(email="test@test.ch")
+        no_write_user = UserFactory.create()
+        story = create_sample_story(user, story_kwargs={'status': Status.TODO})
+        backlog = story.backlog
+        backlog.project.add_user(no_write_user)
+        backlog.project.rebuild_statistic_counters()
+        url = reverse("api_stories_bulk", args=(backlog.pk,))
+        data = [{
+            'as_a': "bulk user {0}".format(i),
+            'i_want_to': "create many stories",
+            'points': 3,
+        } for i in range(3)]
+        data.insert(1, {'id': story.pk, 'status': Status.ACCEPTED})
+        self.client.post(url, data=json.dumps(data), status=401,
+                         content_type="application/json")
+        self.client.post(url, data=json.dumps(data), status=403,
+                         user=no_write_user, content_type="application/json")
+        self.client.post(url, data=json.dumps(data[:1] + [{'id': 9999}]),
+                         status=400, user=user,
+                         content_type="application/json")
+        bad_ids = ["abc", [story.pk], {'id': story.pk}, -1, 0, 1.5, True,
+                   None]
+        response = self.client.post(
+            url, data=json.dumps(data[:1] + [{'id': i} for i in bad_ids]),
+            status=400, user=user, content_type="application/json")
+        self.assertEqual(sorted(response.json['errors'].keys()),
+                         [str(i + 1) for i in range(len(bad_ids))])
+        self.assertEqual(UserStory.objects.count(), 1)
+
+        with CaptureQueriesContext(connection) as queries, mock.patch(
+                "facile_backlog.api.views.notify_changes") as notify:
+            response = self.client.post(url, data=json.dumps(data),
+                                        user=user, status=200,
+                                        content_type="application/json")
+        # the backlog order is notified once for the whole batch
+        self.assertEqual(notify.call_count, 1)
+        message = notify.call_args[0][2]
+        self.assertEqual(message['type'], "stories_moved")
+        self.assertEqual(message['order'],
+                         [story.pk] + [s['id'] for s in response.json
+                                       if s['id'] != story.pk])
+        self.assertEqual([s['as_a'] for s in response.json],
+                         ["bulk user 0", story.as_a, "bulk user 1",
+                          "bulk user 2"])
+        self.assertEqual(response.json[1]['status'], Status.ACCEPTED)
+        stories = list(backlog.ordered_stories)
+        self.assertEqual([s.pk for s in stories],
+                         [story.pk] + [s['id'] for s in response.json
+                                       if s['id'] != story.pk])
+        # the created stories have consecutive numbers, after the numbers
+        # reserved by the process
+        numbers = [s.number for s in stories[1:]]
+        self.assertEqual(numbers, range(numbers[0], numbers[0] + 3))
+        self.assertTrue(numbers[0] > story.number)
+        self.assertEqual(stories[1].code, response.json[0]['code'])
+        counters = backlog.project.statistic_counters.get(
+            scope="all", status=Status.TODO)
+        self.assertEqual((counters.stories, counters.points), (3, 9))
+
+        # the number of queries does not grow with the number of stories
+        more = data + [item for item in data if 'id' not in item] * 3
+        with CaptureQueriesContext(connection) as more_queries:
+            self.client.post(url, data=json.dumps(more), user=user,
+                             status=200, content_type="application/json")
+        self.assertLessEqual(len(more_queries), len(queries))
+
     def test_story_put(self):
         user = UserFactory.create(email="test@test.ch")
         wrong_user = UserFactory.create()
@@ -2,7 +2,9 @@ import json
 from django.core.urlresolvers import reverse
 from django_webtest import WebTest
 
-from facile_backlog.backlog.models import Backlog, Event, Project, Organization
+from facile_backlog.backlog.models import (Backlog, Event, Project,
+                                           Organization, Status,
+                                           prefetch_stats)
 
 from . import factories
 
@@ -515,6 +517,37 @@ class BacklogTest(WebTest):
         self.assertContains(response, us1.as_a)
         self.assertContains(response, us2.as_a)
 
+    def test_backlog_stats(self):
+        user = factories.UserFactory.create()
+        backlog = factories.create_project_sample_backlog(user)
+        empty = factories.BacklogFactory.create(project=backlog.project)
+        for points, status in ((3, Status.TODO), (5, Status.ACCEPTED),
+                               (-1, Status.COMPLETED), (0, Status.COMPLETED)):
+            factories.create_sample_story(user, backlog=backlog, story_kwargs={
+                'points': points,
+                'status': status,
+            })
+        expected = {
+            'total_stories': 4,
+            'estimated_stories': 3,
+            'completed_stories': 2,
+            'percent_estimated': 75.0,
+            'percent_completed': 50.0,
+            'total_points': 8,
+            'estimated_points': 8,
+            'completed_points': 5,
+        }
+        backlog = Backlog.objects.get(pk=backlog.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(backlog.stats, expected)
+        self.assertEqual(backlog.project.stats, expected)
+        with self.assertNumQueries(2):
+            backlogs = prefetch_stats(Backlog.objects.filter(
+                pk__in=(backlog.pk, empty.pk)).order_by("pk"))
+            self.assertEqual(backlogs[0].stats, expected)
+            self.assertEqual(backlogs[1].stats['total_stories'], 0)
+            self.assertEqual(backlogs[1].stats['total_points'], 0)
+
 
 class AjaxTest(WebTest):
     csrf_checks = False
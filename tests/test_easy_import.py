@@ -1,162 +1,194 @@
 import json
-import mock
-from io import BytesIO as BaseBytesIO
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from copy import deepcopy
+
 from django_webtest import WebTest
-from requests import Response
 
 from facile_backlog.backlog.management.commands.easy_import import Command
-from facile_backlog.backlog.models import (Project, UserStory, Backlog)
+from facile_backlog.backlog.models import (Project, UserStory, Backlog, Event,
+                                           Status)
 
 from . import factories
 
 
-class BytesIO(BaseBytesIO):
-    def read(self, *args, **kwargs):
-        kwargs.pop('decode_content', None)
-        return super(BytesIO, self).read(*args, **kwargs)
+# answers of the stub easybacklog API, by requested path
+EASY_API = {
+    "/api/sprint-story-statuses": [
+        {
+            "code": "T",
+            "id": 1,
+            "position": 1,
+            "status": "To do"
+        }
+    ],
+    "/api/accounts": [
+        {
+            "created_at": "2012-05-21T21:33:51Z",
+            "default_rate": None,
+            "default_use_50_90": None,
+            "default_velocity": None,
+            "id": 33,
+            "locale_id": 1,
+            "name": "Sample account",
+            "scoring_rule_id": None,
+            "updated_at": "2012-05-21T21:33:51Z"
+        }
+    ],
+    "/api/accounts/33/backlogs": [
+        {
+            "id": 357,
+            "account_id": 33,
+            "archived": False,
+            "author_id": 1,
+            "company_id": 99,
+            "created_at": "2011-01-03T15:03:00Z",
+            "last_modified_user_id": 1,
+            "name": "Example corporate website backlog",
+            "rate": 800,
+            "scoring_rule_id": None,
+            "updated_at": "2011-02-17T15:03:00Z",
+            "use_50_90": False,
+            "velocity": "3.0"
+        }
+    ],
+    "/api/accounts/33/companies": [
+        {
+            "account_id": 33,
+            "created_at": "2012-05-25T17:11:20Z",
+            "default_rate": 800,
+            "default_use_50_90": False,
+            "default_velocity": "3.0",
+            "id": 99,
+            "name": "Test company",
+            "updated_at": "2012-05-25T17:11:42Z"
+        }
+    ],
+    "/api/backlogs/357/sprints?include_associated_data=true": [
+        {
+            "backlog_id": 357,
+            "completed_at": "2011-01-24T19:05:19Z",
+            "created_at": "2011-01-03T15:03:00Z",
+            "duration_days": 5,
+            "explicit_velocity": None,
+            "id": 224,
+            "iteration": 1,
+            "number_team_members": "1.0",
+            "start_on": "2011-01-17",
+            "updated_at": "2012-05-23T17:42:10Z",
+            "completed?": True,
+            "deletable?": False,
+            "total_allocated_points": 11.0,
+            "total_expected_points": "15.0",
+            "total_completed_points": 11.0,
+            "sprint_stories": [
+                {
+                    "created_at": "2011-01-03T15:03:00Z",
+                    "id": 525,
+                    "position": 1,
+                    "sprint_id": 224,
+                    "sprint_story_status_id": 1,
+                    "story_id": 3159,
+                    "updated_at": "2012-05-23T17:42:10Z"
+                }
+            ]
+        }
+    ],
+    "/api/backlogs/357/themes": [
+        {
+            "backlog_id": 33,
+            "code": "HOP",
+            "created_at": "2012-05-24T13:13:18Z",
+            "id": 1164,
+            "name": "Home page",
+            "position": 1,
+            "updated_at": "2012-05-25T17:11:20Z"
+        }
+    ],
+    "/api/themes/1164/stories?include_associated_data=true": [
+        {
+            "as_a": "user",
+            "color": "",
+            "comments": "Assumed use of JQuery Lightbox",
+            "created_at": "2011-01-03T15:03:00Z",
+            "i_want_to": "view a set of simple screen shots",
+            "id": 3159,
+            "position": 1,
+            "so_i_can": "understand how the products work",
+            "theme_id": 1164,
+            "unique_id": 5,
+            "updated_at": "2012-05-23T17:42:10Z",
+            "score": "3.0",
+            "acceptance_criteria": [{
+                "criterion": "Make test working",
+                "id": 7658,
+                "position": 1,
+                "story_id": 3159
+            }],
+        }
+    ],
+}
 
 
-def json_respnse(data):
-    result = Response()
-    result.encoding = "application/json"
-    result.raw = BytesIO(json.dumps(data))
-    result.status_code = 200
-    return result
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path,
+                                     self.headers.get('Authorization')))
+        if self.path not in self.server.answers:
+            self.send_error(404)
+            return
+        content = json.dumps(self.server.answers[self.path])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
 
+    def log_message(self, *args):
+        pass
 
-def request_get(url, *args, **kwargs):
-    if url.endswith("/api/sprint-story-statuses"):
-        return json_respnse([
-            {
-                "code": "T",
-                "id": 1,
-                "position": 1,
-                "status": "To do"
-            }
-        ])
-    elif url.endswith("/api/accounts"):
-        return json_respnse([
-            {
-                "created_at": "2012-05-21T21:33:51Z",
-                "default_rate": None,
-                "default_use_50_90": None,
-                "default_velocity": None,
-                "id": 33,
-                "locale_id": 1,
-                "name": "Sample account",
-                "scoring_rule_id": None,
-                "updated_at": "2012-05-21T21:33:51Z"
-            }
-        ])
-    elif url.endswith("/accounts/33/backlogs"):
-        return json_respnse([
-            {
-                "id": 357,
-                "account_id": 33,
-                "archived": False,
-                "author_id": 1,
-                "company_id": 99,
-                "created_at": "2011-01-03T15:03:00Z",
-                "last_modified_user_id": 1,
-                "name": "Example corporate website backlog",
-                "rate": 800,
-                "scoring_rule_id": None,
-                "updated_at": "2011-02-17T15:03:00Z",
-                "use_50_90": False,
-                "velocity": "3.0"
-            }
-        ])
-    elif url.endswith("/accounts/33/companies"):
-        return json_respnse([
-            {
-                "account_id": 33,
-                "created_at": "2012-05-25T17:11:20Z",
-                "default_rate": 800,
-                "default_use_50_90": False,
-                "default_velocity": "3.0",
-                "id": 99,
-                "name": "Test company",
-                "updated_at": "2012-05-25T17:11:42Z"
-            }
-        ])
-    elif url.endswith("/api/backlogs/357/sprints?include_associated_data=true"):  # noqa
-        return json_respnse([
-            {
-                "backlog_id": 357,
-                "completed_at": "2011-01-24T19:05:19Z",
-                "created_at": "2011-01-03T15:03:00Z",
-                "duration_days": 5,
-                "explicit_velocity": None,
-                "id": 224,
-                "iteration": 1,
-                "number_team_members": "1.0",
-                "start_on": "2011-01-17",
-                "updated_at": "2012-05-23T17:42:10Z",
-                "completed?": True,
-                "deletable?": False,
-                "total_allocated_points": 11.0,
-                "total_expected_points": "15.0",
-                "total_completed_points": 11.0,
-                "sprint_stories": [
-                    {
-                        "created_at": "2011-01-03T15:03:00Z",
-                        "id": 525,
-                        "position": 1,
-                        "sprint_id": 224,
-                        "sprint_story_status_id": 1,
-                        "story_id": 3159,
-                        "updated_at": "2012-05-23T17:42:10Z"
-                    }
-                ]
-            }
-        ])
-    elif url.endswith("/api/backlogs/357/themes"):
-        return json_respnse([
-            {
-                "backlog_id": 33,
-                "code": "HOP",
-                "created_at": "2012-05-24T13:13:18Z",
-                "id": 1164,
-                "name": "Home page",
-                "position": 1,
-                "updated_at": "2012-05-25T17:11:20Z"
-            }
-        ])
-    elif url.endswith("/api/themes/1164/stories?include_associated_data=true"):
-        return json_respnse([
-            {
-                "as_a": "user",
-                "color": "",
-                "comments": "Assumed use of JQuery Lightbox",
-                "created_at": "2011-01-03T15:03:00Z",
-                "i_want_to": "view a set of simple screen shots",
-                "id": 3159,
-                "position": 1,
-                "so_i_can": "understand how the products work",
-                "theme_id": 1164,
-                "unique_id": 5,
-                "updated_at": "2012-05-23T17:42:10Z",
-                "score": "3.0",
-                "acceptance_criteria": [{
-                    "criterion": "Make test working",
-                    "id": 7658,
-                    "position": 1,
-                    "story_id": 3159
-                }],
-            }
-        ])
-    else:
-        raise NotImplementedError(url)
+
+class StubServer(HTTPServer):
+    """
+    Local easybacklog API, serving the answers in a thread
+    """
+    def __init__(self, answers):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.answers = answers
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{0}/api/".format(self.server_port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def easy_import(answers, *args):
+    with StubServer(answers) as server:
+        Command().handle(*args, api_url=server.api_url, threads=4)
+    return server
 
 
 class HomeTest(WebTest):
 
-    @mock.patch("requests.get")
-    def test_doc_index(self, get):
-        get.side_effect = request_get
+    def test_doc_index(self):
         factories.UserFactory.create(email="test@test.com")
-        Command().handle('test@test.com', 'Test company',
-                         'Example corporate website backlog', 'My project')
+        server = easy_import(EASY_API, 'test@test.com', 'Test company',
+                             'Example corporate website backlog',
+                             'My project')
+        self.assertEqual(len(server.requests), len(EASY_API))
+        self.assertEqual(set(r[1] for r in server.requests),
+                         set(["token test-easybacklog-token"]))
         project = Project.objects.get()
         self.assertEqual(project.name, "My project")
         backlogs = Backlog.objects.all()
@@ -169,3 +201,58 @@ class HomeTest(WebTest):
                                      "the products work")
         self.assertTrue(story.project == project)
         self.assertEqual(story.acceptances, "- Make test working\n")
+
+    def test_import_batches(self):
+        answers = deepcopy(EASY_API)
+        answers["/api/sprint-story-statuses"].append({
+            "code": "A",
+            "id": 2,
+            "position": 2,
+            "status": "Accepted"
+        })
+        answers["/api/backlogs/357/themes"].append({
+            "backlog_id": 33,
+            "code": "CON",
+            "id": 1165,
+            "name": "Contact",
+            "position": 2,
+        })
+        sprint = answers[
+            "/api/backlogs/357/sprints?include_associated_data=true"][0]
+        stories = []
+        for i in range(30):
+            story = deepcopy(answers[
+                "/api/themes/1164/stories?include_associated_data=true"][0])
+            story.update(id=4000 + i, position=i + 1, theme_id=1165,
+                         i_want_to="contact {0}".format(i))
+            stories.append(story)
+            if i % 3 == 0:
+                sprint["sprint_stories"].append({
+                    "id": 600 + i,
+                    "sprint_id": 224,
+                    "sprint_story_status_id": 2,
+                    "story_id": 4000 + i,
+                })
+        answers["/api/themes/1165/stories?include_associated_data=true"] = \
+            stories
+        user = factories.UserFactory.create(email="test@test.com")
+        easy_import(answers, 'test@test.com', 'Test company',
+                    'Example corporate website backlog', 'My project')
+
+        project = Project.objects.get()
+        self.assertEqual(project.story_counter, 31)
+        imported = project.stories.order_by("number")
+        self.assertEqual([s.number for s in imported], range(1, 32))
+        self.assertEqual(imported[0].theme, "Home page")
+        self.assertEqual(imported[1].theme, "Contact")
+        self.assertEqual(imported[1].i_want_to, "contact 0")
+        self.assertEqual(imported[1].code,
+                         u"{0}-2".format(project.code))
+        accepted = project.stories.filter(status=Status.ACCEPTED)
+        self.assertEqual(accepted.count(), 10)
+        self.assertEqual(set(s.backlog_id for s in accepted),
+                         set([Backlog.objects.get(kind=Backlog.COMPLETED).pk]))
+        self.assertEqual(project.main_backlog.stories.count(), 21)
+        events = Event.objects.filter(project=project, story__isnull=False)
+        self.assertEqual(events.count(), 31)
+        self.assertEqual(set(e.user_id for e in events), set([user.pk]))
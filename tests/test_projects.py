@@ -1,11 +1,14 @@
 # coding=utf-8
 
 import urllib
+from django.core.cache import cache
+from django.core.signals import request_finished
 from django.core.urlresolvers import reverse
 from django_webtest import WebTest
 
 from facile_backlog.backlog.models import (Project, AuthorizationAssociation,
-                                           UserStory, Event, Statistic)
+                                           UserStory, Event, Statistic,
+                                           acl_cache_key)
 
 from . import factories
 
@@ -380,3 +383,59 @@ class ProjectTest(WebTest):
         form.submit().follow()
         proj = Project.objects.get(pk=proj.pk)
         self.assertFalse(proj.is_archive)
+
+    def test_project_acl_cache(self):
+        user = factories.UserFactory.create()
+        user_ro = factories.UserFactory.create()
+        proj = factories.ProjectFactory.create(owner=user)
+        self.assertTrue(proj.can_admin(user))
+        self.assertFalse(proj.can_read(user_ro))
+
+        # a fresh instance gets its ACL from the cache
+        proj = Project.objects.get(pk=proj.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(proj.can_read(user))
+            self.assertFalse(proj.can_admin(user_ro))
+
+        proj.add_user(user_ro)
+        proj = Project.objects.get(pk=proj.pk)
+        self.assertTrue(proj.can_read(user_ro))
+        self.assertFalse(proj.can_admin(user_ro))
+
+        proj.remove_user(user_ro)
+        proj = Project.objects.get(pk=proj.pk)
+        self.assertFalse(proj.can_read(user_ro))
+
+        # the ACL follows the users whatever their email
+        user.email = "renamed@test.ch"
+        user.save()
+        proj = Project.objects.get(pk=proj.pk)
+        self.assertTrue(proj.can_admin(user))
+
+        # associations deleted in cascade with their user
+        proj.add_user(user_ro)
+        proj = Project.objects.get(pk=proj.pk)
+        self.assertTrue(proj.can_read(user_ro))
+        user_ro.delete()
+        newcomer = factories.UserFactory.create()
+        proj = Project.objects.get(pk=proj.pk)
+        self.assertFalse(proj.can_read(newcomer))
+        self.assertEqual(proj.get_acl()['read'], set([user.pk]))
+
+    def test_project_acl_cache_after_commit(self):
+        user = factories.UserFactory.create()
+        user_ro = factories.UserFactory.create()
+        proj = factories.ProjectFactory.create(owner=user)
+        proj.add_user(user_ro)
+        key = acl_cache_key("project", proj.pk)
+        stale = Project.objects.get(pk=proj.pk).get_acl()
+
+        # cached again by a request reading before the revocation commit
+        proj.remove_user(user_ro)
+        cache.set(key, stale)
+        self.assertTrue(Project.objects.get(pk=proj.pk).can_read(user_ro))
+
+        # dropped again once the request transaction is over
+        request_finished.send(sender=self.__class__)
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(Project.objects.get(pk=proj.pk).can_read(user_ro))
@@ -1,12 +1,15 @@
 from datetime import timedelta
 
+import mock
+
 from django.core.urlresolvers import reverse
 from django_webtest import WebTest
 from django.utils import timezone
 
-from facile_backlog.backlog.models import Status
+from facile_backlog.backlog.models import (Status, Statistic, Project,
+                                           UserStory, Backlog, DeletedStory)
 from facile_backlog.backlog.management.commands.generate_statistics \
-    import Command
+    import Command, changed_projects
 import factories
 
 
@@ -82,6 +85,128 @@ class StatisticsTest(WebTest):
         self.assertEqual(data['main']['by_status']['to_do']['points'], 11)
         self.assertEqual(data['main']['by_status']['to_do']['stories'], 1)
 
+    def test_counters(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        project = factories.create_sample_project(user)
+        backlog = factories.create_org_sample_backlog(user, backlog_kwargs={
+            'project': project
+        })
+        backlog_main = factories.create_org_sample_backlog(
+            user, backlog_kwargs={
+                'project': project,
+                'is_main': True,
+            }
+        )
+        story = factories.UserStoryFactory.create(
+            project=project,
+            backlog=backlog,
+            points=5,
+            status=Status.TODO,
+        )
+        # counters are built on first use
+        self.assertFalse(project.statistic_counters.exists())
+        project.generate_daily_statistics()
+        self.assertTrue(project.statistic_counters.exists())
+
+        # then they follow story changes
+        factories.UserStoryFactory.create(
+            project=project,
+            backlog=backlog_main,
+            points=-1,
+            status=Status.TODO,
+        )
+        story.status = Status.IN_PROGRESS
+        story.save()
+        story.move_to(backlog_main)
+        data = project.statistic_counters_data()
+        self.assertEqual(data['all']['stories'], 2)
+        self.assertEqual(data['all']['points'], 5)
+        self.assertEqual(data['all']['non_estimated'], 1)
+        self.assertEqual(data['main']['stories'], 2)
+        self.assertEqual(data['main']['by_status']['in_progress']['points'],
+                         5)
+        self.assertEqual(data['main']['by_status']['to_do']['stories'], 1)
+
+        story.delete()
+        data = project.statistic_counters_data()
+        self.assertEqual(data['all']['points'], 0)
+        self.assertEqual(data['main']['stories'], 1)
+        self.assertNotIn('in_progress', data['main']['by_status'])
+
+        # counters match a full computation
+        project.reset_statistic_counters()
+        self.assertEqual(data, project.statistic_counters_data())
+
+    def test_counter_updates(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        backlog = factories.create_project_sample_backlog(
+            user, backlog_kwargs={'is_main': True})
+        project = backlog.project
+        story = factories.UserStoryFactory.create(
+            backlog=backlog, points=3, status=Status.TODO)
+        counters = project.rebuild_statistic_counters()
+        self.assertEqual(len(counters), 10)
+
+        # the story and both counters are updated, the loaded backlog tells
+        # whether it is the main one
+        story = UserStory.objects.select_related("backlog").get(pk=story.pk)
+        story.status = Status.IN_PROGRESS
+        with self.assertNumQueries(4):
+            story.save()
+        data = project.statistic_counters_data()
+        self.assertEqual(data['main']['by_status']['in_progress']['points'],
+                         3)
+
+        # counters created meanwhile are read back
+        with mock.patch.object(Project, "reset_statistic_counters"):
+            counters = project.rebuild_statistic_counters()
+        self.assertEqual(len(counters), 10)
+        self.assertEqual(data, project.statistic_counters_data())
+
+    def test_counters_org_main_backlog(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        backlog = factories.create_project_sample_backlog(
+            user, backlog_kwargs={'is_main': True})
+        project = backlog.project
+        org_main = factories.create_org_sample_backlog(
+            user, backlog_kwargs={'is_main': True})
+        story = factories.UserStoryFactory.create(
+            project=project, backlog=backlog, points=3, status=Status.TODO)
+        project.rebuild_statistic_counters()
+
+        # the main backlog of an organization is not the project main one
+        story.move_to(org_main)
+        story = UserStory.objects.get(pk=story.pk)
+        story.status = Status.IN_PROGRESS
+        story.save()
+        data = project.statistic_counters_data()
+        self.assertEqual(data['all']['points'], 3)
+        self.assertEqual(data['main']['stories'], 0)
+        project.reset_statistic_counters()
+        self.assertEqual(data, project.statistic_counters_data())
+
+    def test_counters_missing(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        backlog = factories.create_project_sample_backlog(
+            user, backlog_kwargs={'is_main': True})
+        story = factories.UserStoryFactory.create(
+            backlog=backlog, points=3, status=Status.TODO)
+        story = UserStory.objects.select_related("backlog").get(pk=story.pk)
+        story.status = Status.IN_PROGRESS
+
+        # the counter updates find nothing and lock nothing, the counters
+        # are built on first use
+        with self.assertNumQueries(4):
+            story.save()
+        self.assertFalse(backlog.project.statistic_counters.exists())
+        data = backlog.project.statistic_counters_data()
+        self.assertEqual(data['main']['by_status']['in_progress']['points'],
+                         3)
+
     def test_view(self):
         user = factories.UserFactory.create(
             email='test@fake.ch', password='pass')
@@ -133,3 +258,81 @@ class StatisticsTest(WebTest):
         self.assertFalse(project.statistics.exists())
         Command().handle()
         self.assertTrue(project.statistics.exists())
+
+    def test_command_since(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        project = factories.create_sample_project(user)
+        other = factories.create_sample_project(user)
+        Command().handle()
+        self.assertEqual(project.statistics.count(), 1)
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        project.statistics.update(day=tomorrow)
+        other.statistics.update(day=tomorrow - timedelta(days=3))
+        for p in (project, other):
+            factories.create_sample_story(
+                user, backlog=factories.BacklogFactory.create(project=p))
+        Command().handle(since=True)
+        self.assertEqual(project.statistics.count(), 1)
+        self.assertEqual(other.statistics.count(), 2)
+
+    def test_changed_projects(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        backlog = factories.create_project_sample_backlog(user)
+        project = backlog.project
+        story = factories.create_sample_story(user, backlog=backlog)
+        project.generate_daily_statistics()
+
+        def age():
+            past = timezone.now() - timedelta(days=2)
+            Project.objects.update(last_modified=past)
+            Backlog.objects.update(last_modified=past)
+            UserStory.objects.update(modified=past)
+            DeletedStory.objects.update(deleted=past)
+
+        age()
+        self.assertEqual(changed_projects(), [])
+        factories.create_sample_story(user, backlog=backlog)
+        self.assertEqual(changed_projects(), [project.pk])
+        age()
+        story.delete()
+        self.assertEqual(changed_projects(), [project.pk])
+
+    def test_compact(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        project = factories.create_sample_project(user)
+        today = timezone.now().date()
+        for days, data in enumerate(({'a': 1}, {'a': 1}, {'a': 2}, {'a': 1},
+                                     {'a': 1}, {'a': 1}, {'b': 1})):
+            Statistic.objects.create(project=project, data=data,
+                                     day=today - timedelta(days=days))
+        # rows stored before the digest column existed
+        project.statistics.filter(day=today).update(digest="")
+        project.compact_statistics()
+        self.assertEqual(
+            [s.data for s in project.statistics.all()],
+            [{'a': 1}, {'a': 2}, {'a': 1}, {'b': 1}]
+        )
+        self.assertEqual(
+            [s.day for s in project.statistics.all()],
+            [today, today - timedelta(days=2), today - timedelta(days=3),
+             today - timedelta(days=6)]
+        )
+
+    def test_unchanged(self):
+        user = factories.UserFactory.create(
+            email='test@fake.ch', password='pass')
+        project = factories.create_sample_project(user)
+        stat, created = project.generate_daily_statistics()
+        self.assertTrue(created)
+        self.assertEqual(len(stat.digest), 40)
+        project.statistics.update(day=timezone.now() - timedelta(days=1))
+        self.assertEqual(project.generate_daily_statistics(), (None, False))
+        factories.create_sample_story(
+            user, backlog=factories.BacklogFactory.create(project=project))
+        other, created = project.generate_daily_statistics()
+        self.assertTrue(created)
+        self.assertFalse(other.same_data(stat))
+        self.assertTrue(stat.same_data(Statistic.objects.get(pk=stat.pk)))
@@ -1,9 +1,16 @@
 import json
+import mock
 
 from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
 from django_webtest import WebTest
 
-from facile_backlog.backlog.models import UserStory, Backlog, Event, Status
+from facile_backlog.backlog.models import (UserStory, Backlog, Event, Status,
+                                           Project, reorder, STORY_ORDER_GAP,
+                                           story_numbers, story_numbers_key)
+
+from facile_backlog.api.notify import flush_outbox, get_redis
 
 from . import factories
 
@@ -270,6 +277,60 @@ class AjaxTest(WebTest):
         self.assertEqual(event.user, user)
         self.assertEqual(event.story.pk, order[0])
 
+    def test_bulk_reorder(self):
+        user = factories.UserFactory.create()
+        backlog = factories.create_project_sample_backlog(user)
+        for i in range(10):
+            factories.UserStoryFactory.create(
+                backlog=backlog,
+                order=i,
+            )
+        order = [c.pk for c in backlog.ordered_stories.all()]
+        moved = order.pop(7)
+        order.insert(2, moved)
+        # only listed stories, the others are placed after
+        with self.assertNumQueries(2):
+            self.assertTrue(reorder(backlog.stories.all(), order[:5]))
+        result_order = [c.pk for c in backlog.ordered_stories.all()]
+        self.assertEqual(order, result_order)
+        self.assertEqual([c.order for c in backlog.ordered_stories.all()],
+                         range(10))
+        # nothing to write
+        with self.assertNumQueries(1):
+            self.assertFalse(reorder(backlog.stories.all(), order))
+
+    def test_sparse_move(self):
+        user = factories.UserFactory.create()
+        backlog = factories.create_project_sample_backlog(user)
+        for i in range(1, 6):
+            factories.UserStoryFactory.create(
+                backlog=backlog,
+                order=i * STORY_ORDER_GAP,
+            )
+        order = [c.pk for c in backlog.ordered_stories.all()]
+        story = UserStory.objects.get(pk=order.pop(3))
+        order.insert(1, story.pk)
+        # only the moved story is written
+        with self.assertNumQueries(2):
+            touched, neighbours = backlog.move_story(story, order)
+        self.assertTrue(touched)
+        self.assertEqual(neighbours, (order[0], order[2]))
+        self.assertEqual(story.order, STORY_ORDER_GAP * 3 / 2)
+        self.assertEqual(order, [c.pk for c in backlog.ordered_stories.all()])
+
+        # no gap left between the first two stories, backlog is re-numbered
+        UserStory.objects.filter(pk=story.pk).update(
+            order=STORY_ORDER_GAP + 1)
+        story = UserStory.objects.get(pk=order.pop())
+        order.insert(1, story.pk)
+        touched, neighbours = backlog.move_story(story, order)
+        self.assertTrue(touched)
+        self.assertIsNone(neighbours)
+        self.assertEqual(order, [c.pk for c in backlog.ordered_stories.all()])
+        self.assertEqual([c.order for c in backlog.ordered_stories.all()],
+                         range(STORY_ORDER_GAP, 6 * STORY_ORDER_GAP,
+                               STORY_ORDER_GAP))
+
     def test_project_story_move(self):
         user = factories.UserFactory.create(
             email='test@fake.ch', password='pass')
@@ -368,6 +429,41 @@ class AjaxTest(WebTest):
         )
         self.assertEqual(events.all()[0].user, user)
 
+    @mock.patch("facile_backlog.api.notify.publish")
+    def test_story_move_notifications(self, publish):
+        user = factories.UserFactory.create()
+        org = factories.create_sample_organization(user)
+        backlog = factories.create_project_sample_backlog(
+            user, project_kwargs={'org': org})
+        story = factories.create_sample_story(user, backlog=backlog)
+        source, backlog = backlog, factories.BacklogFactory.create(
+            project=backlog.project)
+        data = json.dumps({
+            'moved_story': story.pk,
+            'target_backlog': backlog.pk,
+            'order': [story.pk],
+        })
+        self.app.post(reverse('api_move_story'), data,
+                      content_type="application/json", user=user)
+        flush_outbox()
+        # project and organization notifications in one round trip
+        self.assertEqual(publish.call_count, 1)
+        messages = publish.call_args[0][0]
+        self.assertEqual(
+            [channel for channel, m in messages],
+            ["projects:{0}".format(backlog.project_id),
+             "organizations:{0}".format(org.pk)]
+        )
+        data = json.loads(messages[0][1])
+        self.assertEqual(data['backlog_id'], backlog.pk)
+        self.assertEqual(data['revision'], 1)
+        self.assertEqual(data['source_backlog_id'], source.pk)
+        self.assertEqual(data['source_revision'], 1)
+        self.assertEqual(data['moved_story_id'], story.pk)
+        self.assertEqual(
+            (data['previous_story_id'], data['next_story_id']), (None, None))
+        self.assertNotIn('order', data)
+
     def test_story_move_back_to_main(self):
         user = factories.UserFactory.create(
             email='test@fake.ch', password='pass')
@@ -526,3 +622,41 @@ class AjaxTest(WebTest):
                       user=user)
         story = UserStory.objects.get(pk=story.pk)
         self.assertEqual(story.status, Status.COMPLETED)
+
+
+@override_settings(STORY_NUMBER_BLOCK=5)
+class StoryNumberTest(TestCase):
+    def test_story_number_block(self):
+        user = factories.UserFactory.create()
+        backlog = factories.create_project_sample_backlog(user)
+        project = backlog.project
+        stories = [factories.UserStoryFactory.create(backlog=backlog)
+                   for i in range(3)]
+        self.assertEqual([s.number for s in stories], [1, 2, 3])
+        self.assertEqual(stories[2].code, u"{0}-3".format(project.code))
+        # the whole block is reserved at once
+        key = story_numbers_key(project.pk)
+        self.assertEqual(int(get_redis().get(key)), 5)
+        self.assertEqual(Project.objects.get(pk=project.pk).story_counter, 5)
+
+        # another process starts after the reserved block
+        story_numbers.clear()
+        story = factories.UserStoryFactory.create(backlog=backlog)
+        self.assertEqual(story.number, 6)
+        self.assertEqual(project.reserve_story_numbers(10), 11)
+        self.assertEqual(Project.objects.get(pk=project.pk).story_counter, 20)
+        self.assertEqual(
+            factories.UserStoryFactory.create(backlog=backlog).number, 7)
+
+        # the counter lost by redis is seeded again from the database
+        get_redis().delete(key)
+        self.assertEqual(project.reserve_story_numbers(2), 21)
+        self.assertEqual(int(get_redis().get(key)), 22)
+
+        # a new project with a recycled primary key starts from 1
+        story_numbers[project.pk + 1] = [40, 45]
+        get_redis().set(story_numbers_key(project.pk + 1), 45)
+        other = factories.create_project_sample_backlog(user)
+        self.assertEqual(other.project.pk, project.pk + 1)
+        story = factories.UserStoryFactory.create(backlog=other)
+        self.assertEqual(story.number, 1)
@@ -1,5 +1,9 @@
 import datetime
 import json
+import mock
+import redis
+import threading
+import time
 
 from functools import partial
 
@@ -7,13 +11,20 @@ from tornado.testing import AsyncHTTPTestCase, gen_test
 from tornado.web import Application
 from tornado.ioloop import IOLoop
 
-from facile_backlog.websockets import SocketHandler, start_listener
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
 
+from facile_backlog import websockets
+from facile_backlog.websockets import (SocketHandler, start_listener, CLIENTS,
+                                       write_to_clients, flush_clients)
+
+from facile_backlog.api import notify
 from facile_backlog.api.notify import notify_changes
 
 import websocket
 
-from factories import UserFactory
+from factories import UserFactory, ProjectFactory, create_sample_project
 
 
 class TestWebSockets(AsyncHTTPTestCase):
@@ -31,6 +42,7 @@ class TestWebSockets(AsyncHTTPTestCase):
 
     def setUp(self):
         self._test_user = UserFactory.create()
+        self.project = create_sample_project(self._test_user)
         super(TestWebSockets, self).setUp()
 
     @gen_test
@@ -49,22 +61,328 @@ class TestWebSockets(AsyncHTTPTestCase):
                 t = mess['type']
                 if t == 'test-end':
                     _self.io_loop.add_callback(_self.stop)
-                elif t == 'user_join':
-                    _self.assertEqual(mess['user'], _self._test_user.email)
-                    _self.assertEqual(len(mess['users']), 1)
+                elif t == 'presence':
+                    _self.assertEqual(mess['users'], [_self._test_user.email])
                 elif t == 'test-message':
                     _self.assertEqual(mess['data'], "hello")
                 else:
                     _self.fail("Unknown message {0}".format(mess))
 
         start_listener()
-        self.io_loop.add_callback(
-            partial(WSClient, self.get_url('/ws/projects/1/'), self.io_loop))
+        url = self.get_url('/ws/projects/{0}/'.format(self.project.pk))
+        self.io_loop.add_callback(partial(WSClient, url, self.io_loop))
 
         def action():
-            notify_changes("projects", 1, {
+            notify_changes("projects", self.project.pk, {
                 'type': 'test-end'
             })
 
         self.io_loop.add_timeout(datetime.timedelta(seconds=1), action)
         self.wait()
+
+    def test_shared_presence(self):
+        _self = self
+        other = UserFactory.create()
+
+        class WSClient(websocket.WebSocket):
+            def on_message(self, data):
+                mess = json.loads(data)
+                if mess['type'] == 'presence':
+                    _self.assertEqual(mess['users'], sorted(
+                        [_self._test_user.email, other.email]))
+                    _self.io_loop.add_callback(_self.stop)
+
+        r = redis.Redis(*settings.REDIS_URL.split(":"), db=websockets.REDIS_DB)
+        key = "presence:projects:{0}".format(self.project.pk)
+        processes = websockets.PRESENCE_PROCESSES
+        # a previous run of this process, a stopped process and a live one
+        stale = "7-previous|{0}".format(self._test_user.email)
+        dead = "8-stopped|ghost@example.com"
+        live = "9-running|{0}".format(other.email)
+        r.hmset(key, {stale: 3, dead: 1, live: 1})
+        r.hmset(processes, {"8-stopped": time.time() - 1,
+                            "9-running": time.time() + 60})
+        start_listener(shared_process_id=7)
+        try:
+            self.io_loop.add_timeout(datetime.timedelta(seconds=1), partial(
+                WSClient,
+                self.get_url('/ws/projects/{0}/'.format(self.project.pk)),
+                self.io_loop))
+            self.wait()
+            field = "{0}|{1}".format(websockets.process_token,
+                                     self._test_user.email)
+            self.assertEqual(r.hgetall(key), {field: "1", live: "1"})
+            self.assertEqual(sorted(r.hkeys(processes)),
+                             sorted([websockets.process_token, "9-running"]))
+        finally:
+            websockets.presence_client = None
+            r.delete(key, processes)
+
+    def test_resend_presence(self):
+        _self = self
+        other = UserFactory.create()
+        r = redis.Redis(*settings.REDIS_URL.split(":"), db=websockets.REDIS_DB)
+        key = "presence:projects:{0}".format(self.project.pk)
+        processes = websockets.PRESENCE_PROCESSES
+        snapshots = []
+
+        class WSClient(websocket.WebSocket):
+            def on_message(self, data):
+                mess = json.loads(data)
+                if mess['type'] != 'presence':
+                    return
+                snapshots.append(mess['users'])
+                if len(snapshots) == 1:
+                    # joined through another process, its delta is missed
+                    r.hset(key, "9-running|{0}".format(other.email), 1)
+                    r.hset(processes, "9-running", time.time() + 60)
+                    websockets.keepalive()
+                else:
+                    _self.io_loop.add_callback(_self.stop)
+
+        start_listener(shared_process_id=7)
+        try:
+            self.io_loop.add_callback(partial(
+                WSClient,
+                self.get_url('/ws/projects/{0}/'.format(self.project.pk)),
+                self.io_loop))
+            self.wait()
+            self.assertEqual(snapshots, [
+                [self._test_user.email],
+                sorted([self._test_user.email, other.email]),
+            ])
+        finally:
+            websockets.presence_client = None
+            r.delete(key, processes)
+
+    def test_no_access(self):
+        _self = self
+
+        class WSClient(websocket.WebSocket):
+            def on_message(self, data):
+                _self.fail("Unexpected message {0}".format(data))
+
+            def close(self):
+                # closed by the server
+                super(WSClient, self).close()
+                _self.io_loop.add_callback(_self.stop)
+
+        project = ProjectFactory.create()
+        self.io_loop.add_callback(partial(
+            WSClient, self.get_url('/ws/projects/{0}/'.format(project.pk)),
+            self.io_loop))
+        self.wait()
+        self.assertFalse(CLIENTS.get("projects:{0}".format(project.pk)))
+
+    def test_close(self):
+        _self = self
+        key = "projects:{0}".format(self.project.pk)
+
+        def closed():
+            _self.assertNotIn(key, CLIENTS)
+            _self.assertEqual(websockets.counters['closed'],
+                              counters['closed'] + 1)
+            _self.stop()
+
+        class WSClient(websocket.WebSocket):
+            def on_message(self, data):
+                _self.assertEqual(websockets.socket_metrics()['channels'],
+                                  {key: 1})
+                self.close()
+                _self.io_loop.add_timeout(datetime.timedelta(seconds=0.5),
+                                          closed)
+
+        counters = dict(websockets.counters)
+        url = self.get_url('/ws/projects/{0}/'.format(self.project.pk))
+        self.io_loop.add_callback(partial(WSClient, url, self.io_loop))
+        self.wait()
+
+    def test_keepalive(self):
+        _self = self
+        key = "projects:{0}".format(self.project.pk)
+
+        class WSClient(websocket.WebSocket):
+            def on_message(self, data):
+                # silent client
+                for c in CLIENTS[key]:
+                    c.last_seen -= settings.WEBSOCKET_PING_TIMEOUT + 1
+                websockets.keepalive()
+                _self.assertNotIn(key, CLIENTS)
+                _self.assertEqual(websockets.counters['timed_out'],
+                                  timed_out + 1)
+                _self.io_loop.add_callback(_self.stop)
+
+        timed_out = websockets.counters['timed_out']
+        url = self.get_url('/ws/projects/{0}/'.format(self.project.pk))
+        self.io_loop.add_callback(partial(WSClient, url, self.io_loop))
+        self.wait()
+
+
+class TestSessionUser(TestCase):
+    def tearDown(self):
+        websockets.SESSION_USERS.clear()
+
+    def test_cached(self):
+        user = UserFactory.create()
+        self.client.login(username=user.email, password="123")
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        project = create_sample_project(user)
+        with self.assertNumQueries(3):
+            self.assertEqual(websockets.resolve_client(
+                session_key, "projects", project.pk), user)
+        # the user of the session is cached
+        with self.assertNumQueries(1):
+            self.assertEqual(websockets.resolve_client(
+                session_key, "projects", project.pk), user)
+        self.assertIsNone(websockets.resolve_client(
+            session_key, "projects", ProjectFactory.create().pk))
+        self.assertIsNone(websockets.resolve_client(
+            session_key, "backlogs", project.pk))
+        self.assertIsNone(websockets.resolve_client(
+            "unknown", "projects", project.pk))
+
+    def test_cache_lock(self):
+        # the cache is shared by the authentication threads
+        thread = threading.Thread(target=websockets.session_user,
+                                  args=("unknown",))
+        with websockets.session_users_lock:
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertNotIn("unknown", websockets.SESSION_USERS)
+        thread.join()
+        self.assertIn("unknown", websockets.SESSION_USERS)
+
+
+class FakeClient(object):
+    ws_connection = True
+
+    def __init__(self):
+        self.messages = []
+
+    def write_message(self, data):
+        self.messages.append(data)
+
+
+class TestFanOut(TestCase):
+    def setUp(self):
+        self.clients = [FakeClient(), FakeClient()]
+        CLIENTS["projects:1"] = set(self.clients)
+
+    def tearDown(self):
+        CLIENTS.pop("projects:1")
+
+    def test_coalesce(self):
+        moved = {
+            'type': "stories_moved",
+            'backlog_id': 1,
+            'moved_story_id': 3,
+            'previous_story_id': 2,
+            'next_story_id': None,
+        }
+        write_to_clients("projects:1", moved)
+        write_to_clients("projects:1", dict(moved, backlog_id=2))
+        write_to_clients("projects:1", {'type': "story_changed"})
+        write_to_clients("projects:1", dict(moved, order=[3, 2]))
+        write_to_clients("projects:1", {'type': "backlogs_moved",
+                                        'order': [1, 2]})
+        write_to_clients("projects:1", {'type': "backlogs_moved",
+                                        'order': [2, 1]})
+        flush_clients()
+        for client in self.clients:
+            messages = [json.loads(m) for m in client.messages]
+            self.assertEqual(
+                [(m['type'], m.get('backlog_id')) for m in messages],
+                [("stories_moved", 2), ("story_changed", None),
+                 ("stories_moved", 1), ("backlogs_moved", None)]
+            )
+            self.assertEqual(messages[2]['order'], [3, 2])
+            self.assertEqual(messages[3]['order'], [2, 1])
+        # the payload is serialized once for all the clients
+        self.assertIs(self.clients[0].messages[0],
+                      self.clients[1].messages[0])
+
+
+class TestPresence(TestCase):
+    def setUp(self):
+        self.users = [UserFactory.build(), UserFactory.build()]
+
+    def tearDown(self):
+        CLIENTS.pop("projects:1", None)
+        websockets.PRESENCE.pop("projects:1", None)
+
+    def connect(self, user):
+        client = FakeClient()
+        client.user = user
+        client.client_key = "projects:1"
+        websockets.append_client(client)
+        flush_clients()
+        return client
+
+    def messages(self, client):
+        messages = [json.loads(m) for m in client.messages]
+        client.messages = []
+        return messages
+
+    def test_delta(self):
+        first = self.connect(self.users[0])
+        self.assertEqual(self.messages(first), [
+            {'type': "presence", 'users': [self.users[0].email]}
+        ])
+        # a second tab of the same user is not notified to the others
+        tab = self.connect(self.users[0])
+        self.assertEqual(self.messages(first), [])
+        self.assertEqual(self.messages(tab), [
+            {'type': "presence", 'users': [self.users[0].email]}
+        ])
+        other = self.connect(self.users[1])
+        self.assertEqual(self.messages(first), [
+            {'type': "user_join", 'user': self.users[1].email}
+        ])
+        self.assertEqual(self.messages(other), [
+            {'type': "presence",
+             'users': sorted(u.email for u in self.users)}
+        ])
+
+        websockets.remove_client(tab)
+        flush_clients()
+        self.assertEqual(self.messages(other), [])
+        websockets.remove_client(first)
+        flush_clients()
+        self.assertEqual(self.messages(other), [
+            {'type': "user_leave", 'user': self.users[0].email}
+        ])
+
+        # snapshot on request
+        websockets.send_presence(other)
+        self.assertEqual(self.messages(other), [
+            {'type': "presence", 'users': [self.users[1].email]}
+        ])
+        websockets.remove_client(other)
+        self.assertNotIn("projects:1", websockets.PRESENCE)
+
+
+class TestOutbox(TestCase):
+    @override_settings(NOTIFICATION_RETRIES=2, NOTIFICATION_RETRY_DELAY=0)
+    def test_retry(self):
+        failures = [redis.ConnectionError("down")] * 3
+        published = []
+
+        def publish(messages):
+            if failures:
+                raise failures.pop()
+            published.extend(messages)
+
+        counters = dict(notify.counters)
+        with mock.patch.object(notify, "publish", publish):
+            notify_changes("projects", 1, {'type': "dropped"})
+            notify.flush_outbox()
+            notify_changes("projects", 1, {'type': "published"})
+            notify.flush_outbox()
+        self.assertEqual(len(published), 1)
+        self.assertEqual(published[0][0], "projects:1")
+        self.assertEqual(json.loads(published[0][1])['type'], "published")
+        self.assertEqual(notify.counters['dropped'], counters['dropped'] + 1)
+        self.assertEqual(notify.counters['retried'], counters['retried'] + 2)
+        self.assertEqual(notify.counters['published'],
+                         counters['published'] + 1)